@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from api.models import Pattern, SquadToken
+from api.models import JobFetchState, JobLease, Pattern, SquadSubmission, SquadToken
 
 
 class PatternAdmin(admin.ModelAdmin):
@@ -11,5 +11,21 @@ class SquadTokenAdmin(admin.ModelAdmin):
     pass
 
 
+class JobFetchStateAdmin(admin.ModelAdmin):
+    list_display = ('lava_job_id', 'lava_server', 'stage', 'attempts', 'updated_at')
+    exclude = ('data',)
+
+
+class JobLeaseAdmin(admin.ModelAdmin):
+    list_display = ('lava_job_id', 'lava_server', 'owner', 'acquired_at', 'expires_at')
+
+
+class SquadSubmissionAdmin(admin.ModelAdmin):
+    list_display = ('job_id', 'team', 'project', 'build', 'environment', 'submitted_at')
+
+
 admin.site.register(Pattern, PatternAdmin)
 admin.site.register(SquadToken, SquadTokenAdmin)
+admin.site.register(JobFetchState, JobFetchStateAdmin)
+admin.site.register(JobLease, JobLeaseAdmin)
+admin.site.register(SquadSubmission, SquadSubmissionAdmin)
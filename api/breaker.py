@@ -0,0 +1,130 @@
+"""
+Per LAVA server circuit breaker shared by all the workers of a host.
+
+After 'failures' consecutive 5xx responses, timeouts or connection errors
+the circuit opens and calls fail immediately with LavaCircuitOpenException
+for 'reset' seconds. Then a single call is let through as a probe: if it
+succeeds the circuit closes, otherwise it opens again. The state is kept
+in "<server>.breaker" under LAVA_BREAKER_DIR.
+"""
+import fcntl
+import json
+import logging
+import time
+import requests
+
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from listener import metrics
+from .serverstate import server_limits, state_path
+from .testminer import LavaServerException, LavaCircuitOpenException, LavaDeadlineException
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+TRANSITIONS = metrics.REGISTRY.counter(
+    'lava_breaker_transitions_total',
+    'Circuit breaker state changes, per server and new state',
+    ['server', 'state'])
+REJECTED = metrics.REGISTRY.counter(
+    'lava_breaker_rejected_total',
+    'LAVA calls refused because the circuit was open, per server',
+    ['server'])
+
+DEFAULT_LIMITS = {
+    'failures': 5,  # consecutive failures that open the circuit
+    'reset': 60,    # seconds before letting a probe call through
+}
+
+
+def is_failure(exception):
+    if isinstance(exception, LavaServerException):
+        return exception.status_code // 100 == 5
+    return isinstance(exception, (requests.Timeout, requests.ConnectionError))
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, netloc, directory, failures, reset):
+        self.netloc = netloc
+        self.failures = max(int(failures), 1)
+        self.reset = float(reset)
+        self.path = state_path(directory, netloc) + '.breaker'
+
+    @contextmanager
+    def locked_state(self):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = {'state': CLOSED, 'failures': 0, 'since': 0}
+                before = dict(state)
+                yield state
+                if state != before:
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                if state['state'] != before['state']:
+                    TRANSITIONS.inc(server=self.netloc, state=state['state'])
+                    logger.warning("circuit for %s is now %s" % (self.netloc, state['state']))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def before_call(self):
+        now = time.time()
+        with self.locked_state() as state:
+            if state['state'] == CLOSED:
+                return
+            # a half-open probe that never reported back (worker killed)
+            # is given up on after another reset period
+            retry_after = state['since'] + self.reset - now
+            if retry_after <= 0:
+                state['state'] = HALF_OPEN
+                state['since'] = now
+                return
+        REJECTED.inc(server=self.netloc)
+        raise LavaCircuitOpenException(self.netloc, retry_after)
+
+    def record(self, failed):
+        with self.locked_state() as state:
+            if not failed:
+                state.update(state=CLOSED, failures=0)
+                return
+            state['failures'] += 1
+            if state['state'] == HALF_OPEN or state['failures'] >= self.failures:
+                state.update(state=OPEN, since=time.time())
+
+    @contextmanager
+    def call(self):
+        self.before_call()
+        try:
+            yield
+        except LavaDeadlineException:
+            # the job ran out of time, not the server; a probe cut short
+            # is let through again after another reset period
+            raise
+        except Exception as e:
+            self.record(is_failure(e))
+            raise
+        self.record(False)
+
+
+def server_breaker(netloc):
+    """
+    Returns the circuit breaker for a LAVA server, or None if
+    LAVA_BREAKER_DIR is not set. Limits come from LAVA_BREAKER[netloc],
+    falling back to LAVA_BREAKER['default'] and then DEFAULT_LIMITS.
+    """
+    directory = getattr(settings, 'LAVA_BREAKER_DIR', None)
+    if not directory:
+        return None
+    return CircuitBreaker(netloc, directory, **server_limits('LAVA_BREAKER', netloc, DEFAULT_LIMITS))
@@ -0,0 +1,86 @@
+"""
+Leases making sure a LAVA job is processed by a single worker at a time.
+
+A lease is a JobLease row keyed by (lava_server, lava_job_id): creating it
+succeeds for one worker only, the others see the IntegrityError and skip
+the job. A lease left behind by a dead worker expires after
+LAVA_JOB_LEASE_TTL seconds and can then be taken over.
+"""
+import os
+import socket
+import time
+
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from listener import metrics
+from .models import JobLease
+
+HOLD_SECONDS = metrics.REGISTRY.histogram(
+    'lava_job_lease_hold_seconds',
+    'Time a LAVA job lease was held')
+LEASES = metrics.REGISTRY.counter(
+    'lava_job_leases_total',
+    'Job lease attempts, per result (acquired, takeover or busy)',
+    ['result'])
+
+
+def lease_owner(name=None):
+    owner = "%s:%d" % (socket.gethostname(), os.getpid())
+    if name:
+        owner = "%s:%s" % (owner, name)
+    return owner
+
+
+def acquire(lava_server, lava_job_id, owner, ttl):
+    """
+    Returns the lease, or None if another worker holds it.
+    """
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=ttl)
+    try:
+        with transaction.atomic():
+            lease = JobLease.objects.create(
+                lava_server=lava_server, lava_job_id=lava_job_id,
+                owner=owner, acquired_at=now, expires_at=expires_at)
+        LEASES.inc(result='acquired')
+        return lease
+    except IntegrityError:
+        pass
+    # the conditional update makes sure only one worker takes over an
+    # expired lease
+    taken = JobLease.objects.filter(
+        lava_server=lava_server, lava_job_id=lava_job_id, expires_at__lte=now,
+    ).update(owner=owner, acquired_at=now, expires_at=expires_at)
+    if not taken:
+        LEASES.inc(result='busy')
+        return None
+    LEASES.inc(result='takeover')
+    return JobLease.objects.get(lava_server=lava_server, lava_job_id=lava_job_id)
+
+
+def release(lease):
+    JobLease.objects.filter(pk=lease.pk, owner=lease.owner).delete()
+
+
+@contextmanager
+def job_lease(lava_server, lava_job_id, owner=None):
+    """
+    Yields the lease for the job, or None if another worker holds it; the
+    lease is released on exit.
+    """
+    ttl = getattr(settings, 'LAVA_JOB_LEASE_TTL', 900)
+    lease = acquire(lava_server, lava_job_id, owner or lease_owner(), ttl)
+    if lease is None:
+        yield None
+        return
+    start = time.time()
+    try:
+        yield lease
+    finally:
+        release(lease)
+        HOLD_SECONDS.observe(time.time() - start)
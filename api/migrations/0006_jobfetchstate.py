@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_squadtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobFetchState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lava_server', models.URLField()),
+                ('lava_job_id', models.CharField(max_length=16)),
+                ('stage', models.CharField(blank=True, default='', max_length=16)),
+                ('status', models.CharField(blank=True, max_length=16, null=True)),
+                ('url', models.URLField(blank=True, null=True)),
+                ('testrunnerclass', models.CharField(blank=True, max_length=64, null=True)),
+                ('details', models.TextField(blank=True, null=True)),
+                ('results', models.TextField(blank=True, null=True)),
+                ('data_name', models.CharField(blank=True, max_length=1024, null=True)),
+                ('data', models.BinaryField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='jobfetchstate',
+            unique_together=set([('lava_server', 'lava_job_id')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_jobfetchstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lava_server', models.URLField()),
+                ('lava_job_id', models.CharField(max_length=16)),
+                ('owner', models.CharField(max_length=256)),
+                ('acquired_at', models.DateTimeField()),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='joblease',
+            unique_together=set([('lava_server', 'lava_job_id')]),
+        ),
+    ]
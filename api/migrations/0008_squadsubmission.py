@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_joblease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SquadSubmission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('team', models.CharField(max_length=1024)),
+                ('project', models.CharField(max_length=1024)),
+                ('build', models.CharField(max_length=1024)),
+                ('environment', models.CharField(max_length=1024)),
+                ('job_id', models.CharField(max_length=16)),
+                ('payload_hash', models.CharField(max_length=64)),
+                ('submitted_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='squadsubmission',
+            unique_together=set([('team', 'project', 'build', 'environment', 'job_id')]),
+        ),
+    ]
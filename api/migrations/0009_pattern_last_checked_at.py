@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_squadsubmission'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pattern',
+            name='last_checked_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -21,8 +21,84 @@ class Pattern(models.Model):
     requester = models.ForeignKey(User)
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
+    # last time the job status was received or polled from LAVA
+    last_checked_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return "%s - %s (%s)" % (self.lava_job_id, self.lava_server, self.requester)
 
 
+
+class JobFetchState(models.Model):
+    """
+    What has been fetched so far for a finished LAVA job, so that a retry
+    after a LAVA failure resumes from the last completed stage instead of
+    downloading everything again.
+    """
+    STAGES = ('status', 'details', 'results', 'data')
+
+    lava_server = models.URLField()
+    lava_job_id = models.CharField(max_length=16)
+    stage = models.CharField(max_length=16, blank=True, default='')
+    status = models.CharField(max_length=16, null=True, blank=True)
+    url = models.URLField(null=True, blank=True)
+    testrunnerclass = models.CharField(max_length=64, null=True, blank=True)
+    details = models.TextField(null=True, blank=True)
+    results = models.TextField(null=True, blank=True)
+    data_name = models.CharField(max_length=1024, null=True, blank=True)
+    data = models.BinaryField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('lava_server', 'lava_job_id')
+
+    def __str__(self):
+        return "%s - %s (%s)" % (self.lava_job_id, self.lava_server, self.stage or 'new')
+
+    def reached(self, stage):
+        return bool(self.stage) and self.STAGES.index(self.stage) >= self.STAGES.index(stage)
+
+    def checkpoint(self, stage, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.stage = stage
+        self.save()
+
+
+class JobLease(models.Model):
+    """
+    Held by the worker processing a LAVA job, so that other workers
+    receiving the same job skip it. Expired leases can be taken over.
+    """
+    lava_server = models.URLField()
+    lava_job_id = models.CharField(max_length=16)
+    owner = models.CharField(max_length=256)
+    acquired_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('lava_server', 'lava_job_id')
+
+    def __str__(self):
+        return "%s - %s (%s)" % (self.lava_job_id, self.lava_server, self.owner)
+
+
+class SquadSubmission(models.Model):
+    """
+    Hash of the last payload submitted to SQUAD for a job, so that
+    submitting the same results again can be skipped.
+    """
+    team = models.CharField(max_length=1024)
+    project = models.CharField(max_length=1024)
+    build = models.CharField(max_length=1024)
+    environment = models.CharField(max_length=1024)
+    job_id = models.CharField(max_length=16)
+    payload_hash = models.CharField(max_length=64)
+    submitted_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('team', 'project', 'build', 'environment', 'job_id')
+
+    def __str__(self):
+        return "%s/%s/%s/%s - %s" % (self.team, self.project, self.build, self.environment, self.job_id)
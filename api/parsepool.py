@@ -0,0 +1,189 @@
+"""
+Process pool for the CPU bound parsing of LAVA answers (JSON bundles,
+YAML definitions, base64 attachments), so that a worker running many
+fetches in threads or greenlets can use all the cores for parsing.
+
+The pool runs PARSE_POOL_WORKERS parser processes started with
+subprocess, each handling one content at a time over its stdin and
+stdout pipes. multiprocessing.Pool is not used: it hangs under eventlet
+monkey patching, and can't be started from the daemonic children of the
+default prefork Celery pool. Callers wait for an idle parser, so at most
+one content per parser is handed over at a time. Contents shorter than
+PARSE_POOL_MIN_SIZE characters are parsed inline, as sending them to
+another process costs more than parsing them.
+"""
+import logging
+import os
+import pickle
+import struct
+import subprocess
+import sys
+import threading
+import time
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from django.conf import settings
+
+from listener import metrics
+
+logger = logging.getLogger(__name__)
+
+PARSE_SECONDS = metrics.REGISTRY.histogram(
+    'lava_parse_seconds',
+    'Time spent parsing LAVA answers, per place (inline or pool)',
+    ['where'])
+PARSE_WAIT_SECONDS = metrics.REGISTRY.histogram(
+    'lava_parse_wait_seconds',
+    'Time spent waiting for an idle parser process')
+
+# messages are pickled and prefixed with their length
+LENGTH = struct.Struct('>Q')
+SERVE = "from api.parsepool import serve; serve()"
+
+
+def write_message(f, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    f.write(LENGTH.pack(len(data)))
+    f.write(data)
+    f.flush()
+
+
+def read_message(f):
+    header = f.read(LENGTH.size)
+    if len(header) < LENGTH.size:
+        raise EOFError("parser process closed its pipe")
+    (length,) = LENGTH.unpack(header)
+    data = f.read(length)
+    if len(data) < length:
+        raise EOFError("parser process closed its pipe")
+    return pickle.loads(data)
+
+
+def serve():
+    """
+    Main loop of a parser process: reads (loader, content) requests from
+    stdin and writes (True, result) or (False, exception) answers.
+    """
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    # answers go to a copy of stdout, so that loaders printing something
+    # write to stderr instead of corrupting them
+    stdout = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    while True:
+        try:
+            loader, content = read_message(stdin)
+        except EOFError:
+            return
+        try:
+            answer = (True, loader(content))
+        except Exception as e:
+            answer = (False, e)
+        try:
+            write_message(stdout, answer)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            write_message(stdout, (False, RuntimeError("unpicklable parse result: %r" % e)))
+
+
+class InlineParser(object):
+
+    def parse(self, loader, content):
+        start = time.time()
+        try:
+            return loader(content)
+        finally:
+            PARSE_SECONDS.observe(time.time() - start, where='inline')
+
+
+class ParserProcess(object):
+
+    def __init__(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+        self.process = subprocess.Popen([sys.executable, '-c', SERVE],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        env=env, close_fds=True)
+
+    def parse(self, loader, content):
+        """
+        Returns (True, result) or (False, exception raised by loader).
+        """
+        write_message(self.process.stdin, (loader, content))
+        return read_message(self.process.stdout)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.close()
+
+
+class ParsePool(InlineParser):
+
+    def __init__(self, workers, min_size=65536):
+        self.min_size = min_size
+        self.idle = Queue()
+        for i in range(workers):
+            self.idle.put(ParserProcess())
+
+    def parse(self, loader, content):
+        if content is None or len(content) < self.min_size:
+            return super(ParsePool, self).parse(loader, content)
+        start = time.time()
+        process = self.idle.get()
+        PARSE_WAIT_SECONDS.observe(time.time() - start)
+        try:
+            ok, result = process.parse(loader, content)
+        except (EOFError, IOError, OSError) as e:
+            # the parser died (out of memory, killed): replace it and
+            # parse inline this time
+            logger.warning("parser process failed, parsing inline: %s" % e)
+            process.kill()
+            self.idle.put(ParserProcess())
+            return super(ParsePool, self).parse(loader, content)
+        except BaseException:
+            # interrupted half way (task timeout), the pipes are out of
+            # step with the parser
+            process.kill()
+            self.idle.put(ParserProcess())
+            raise
+        self.idle.put(process)
+        PARSE_SECONDS.observe(time.time() - start, where='pool')
+        if not ok:
+            raise result
+        return result
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().close()
+
+
+_parser = None
+_lock = threading.Lock()
+
+
+def parser():
+    """
+    The parser for this process: a ParsePool if PARSE_POOL_WORKERS is set,
+    created on first use so that each worker process gets its own, or an
+    InlineParser.
+    """
+    global _parser
+    with _lock:
+        if _parser is None:
+            workers = getattr(settings, 'PARSE_POOL_WORKERS', 0)
+            if workers:
+                _parser = ParsePool(workers, getattr(settings, 'PARSE_POOL_MIN_SIZE', 65536))
+            else:
+                _parser = InlineParser()
+        return _parser
@@ -0,0 +1,99 @@
+"""
+Queue and priority selection for the LAVA job pipeline.
+
+Jobs whose results are parsed by a LavaTestSystem subclass (git clones,
+large bundles) are "heavy" and run on their own queue, so that they do
+not hold up the "light" V2 and plain result jobs. The cost is only known
+once the job definition has been fetched: process_job starts on the light
+queue and moves itself to the heavy one when needed.
+
+LAVA servers listed in LAVA_SHARDS get their own set of queues, named
+"<queue>.<shard>", so that worker pools can be dedicated to a subset of
+servers and a burst from one lab does not delay the others. Tasks on a
+shard queue only match patterns of the servers of that shard.
+
+This module is imported by the listener, so it must stay cheap to import.
+"""
+import re
+
+from django.conf import settings
+
+EVENTS = 'events'
+LIGHT = 'light'
+HEAVY = 'heavy'
+
+DEFAULT_QUEUES = {
+    EVENTS: 'lava-events',
+    LIGHT: 'lava-light',
+    HEAVY: 'lava-heavy',
+}
+
+# LAVA job states after which results can be fetched
+TERMINAL_STATES = ["Complete", "Incomplete", "Canceled"]
+
+# AMQP priorities, higher first; queues are declared with x-max-priority
+TERMINAL_PRIORITY = 9
+STATUS_PRIORITY = 0
+
+
+def result_cost(testrunnerclass):
+    from . import testminer
+    cls = getattr(testminer, testrunnerclass or '', None)
+    if isinstance(cls, type) and issubclass(cls, testminer.LavaTestSystem):
+        return HEAVY
+    return LIGHT
+
+
+def server_shard(netloc):
+    return getattr(settings, 'LAVA_SHARDS', {}).get(netloc)
+
+
+def queue_for(kind, netloc=None):
+    """
+    Queue for events (EVENTS) or jobs of the given cost (LIGHT or HEAVY)
+    from the LAVA server at netloc.
+    """
+    queues = dict(DEFAULT_QUEUES)
+    queues.update(getattr(settings, 'LAVA_QUEUES', {}))
+    queue = queues[kind]
+    shard = server_shard(netloc)
+    if shard:
+        queue = "%s.%s" % (queue, shard)
+    return queue
+
+
+def is_job_queue(queue):
+    if not queue:
+        return False
+    base = queue.split('.', 1)[0]
+    return base in (queue_for(LIGHT), queue_for(HEAVY))
+
+
+def server_filter(netloc):
+    """
+    Pattern lookup arguments restricting a query to the LAVA server at
+    netloc; patterns store the server URL.
+    """
+    if not netloc:
+        return {}
+    return {'lava_server__iregex': r'^[a-z]+://%s(/|$)' % re.escape(netloc)}
+
+
+def event_priority(data):
+    if data.get('status') in TERMINAL_STATES:
+        return TERMINAL_PRIORITY
+    return STATUS_PRIORITY
+
+
+def batch_priority(events):
+    return max([event_priority(event[3]) for event in events] or [STATUS_PRIORITY])
+
+
+class WrongQueue(Exception):
+    """
+    Raised once the cost of a job is known, if it does not match the queue
+    the task was taken from.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+        super(WrongQueue, self).__init__("job belongs to queue %s" % queue)
@@ -13,3 +13,28 @@ class PatternSerializer(serializers.ModelSerializer):
             'build_job_url',
             'created_at',
             'is_active')
+
+
+class LavaEventSerializer(serializers.Serializer):
+    """
+    A LAVA job event, in the format published by LAVA over ZMQ. The field
+    names used by LAVA notification callbacks (id, is_pipeline,
+    status_string) are accepted as well.
+    """
+    lava_server = serializers.URLField(required=False)
+    job = serializers.CharField()
+    sub_id = serializers.CharField(required=False)
+    status = serializers.CharField()
+    pipeline = serializers.BooleanField(required=False, default=False)
+    description = serializers.CharField(required=False, allow_blank=True, default='')
+
+    def to_internal_value(self, data):
+        if isinstance(data, dict):
+            data = dict(data.items())
+            if 'job' not in data and 'id' in data:
+                data['job'] = data['id']
+            if 'pipeline' not in data and 'is_pipeline' in data:
+                data['pipeline'] = data['is_pipeline']
+            if 'status_string' in data:
+                data['status'] = data['status_string'].capitalize()
+        return super(LavaEventSerializer, self).to_internal_value(data)
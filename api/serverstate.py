@@ -0,0 +1,34 @@
+"""
+Helpers for the per LAVA server state that api.throttle and api.breaker
+share between the workers of a host through files.
+"""
+import errno
+import os
+
+from django.conf import settings
+
+
+def state_path(directory, netloc):
+    """
+    Path prefix of the state files of a LAVA server in directory, which is
+    created if needed.
+    """
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return os.path.join(directory, netloc.replace(':', '_'))
+
+
+def server_limits(name, netloc, defaults):
+    """
+    Limits for a LAVA server from the name setting: setting[netloc],
+    falling back to setting['default'] and then defaults.
+    """
+    config = getattr(settings, name, {})
+    limits = dict(defaults)
+    limits.update(config.get('default', {}))
+    limits.update(config.get(netloc, {}))
+    return limits
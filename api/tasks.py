@@ -1,18 +1,32 @@
+import hashlib
 import json
 import logging
+import os
 import requests
+import time
 try:
     from urllib.parse import urlsplit
 except ImportError:
     from urlparse import urlsplit
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 from squadlavalistener import celery_app
-from .models import Pattern, SquadToken
-from . import  testminer
+from .models import JobFetchState, Pattern, SquadSubmission, SquadToken
+from . import  parsepool, routing, testminer
+from .breaker import is_failure, server_breaker
+from .lease import job_lease, lease_owner
+from .throttle import server_throttle
+from .timeouts import AdaptiveTimeouts, job_deadline
+from .transitions import PatternUpdates
+from listener import metrics
+from celery.signals import task_postrun
 from celery.utils.log import get_task_logger
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
 
 logger = get_task_logger(__name__)
 
@@ -30,6 +44,33 @@ requests_log = logging.getLogger("requests.packages.urllib3")
 requests_log.setLevel(logging.DEBUG)
 requests_log.propagate = True
 
+@task_postrun.connect(weak=False)
+def write_worker_metrics(**kwargs):
+    directory = getattr(settings, 'WORKER_METRICS_DIR', None)
+    if directory:
+        path = os.path.join(directory, "worker-%d.prom" % os.getpid())
+        try:
+            metrics.write_textfile(path)
+        except (IOError, OSError) as e:
+            logger.warning("could not write metrics to %s: %s" % (path, e))
+
+# upper bound of the backoff between retries of a failed LAVA fetch
+MAX_RETRY_DELAY = 3600
+# seconds before retrying a multinode sub-job whose group is leased
+LEASE_RETRY_DELAY = 15
+# (pattern age, seconds between status polls) for the reconciler, from
+# the youngest patterns to the oldest; None stands for any age
+RECONCILE_INTERVALS = (
+    (3600, 300),
+    (86400, 1800),
+    (7 * 86400, 3 * 3600),
+    (None, 12 * 3600),
+)
+
+TERMINAL_STATES = routing.TERMINAL_STATES
+# statuses recorded by run_pipeline once a job has been processed
+PROCESSED_STATES = TERMINAL_STATES + ["Results Missing"]
+
 class TestJob(object):
     def __init__(self, pattern, data):
         self.pattern = pattern
@@ -56,82 +97,388 @@ class TestJob(object):
         self.metadata = None
 
 
-@celery_app.task(bind=True)
-def check_job_status(self, pattern, data):
-    # check status of the test job in LAVA
-    pattern.lava_job_status = data['status']
-    # set job status and collect data
-    if data['pipeline']:
-        # check v2 job
-        set_v2_testjob_results.delay(pattern, data)
-    else:
-        set_testjob_results.delay(pattern, data)
+class StageTimer(object):
+    """
+    Accumulates the time spent in each stage of processing a job.
+    """
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.time() - start
+
+    def report(self):
+        stages = " ".join("%s=%.3fs" % item for item in self.timings.items())
+        logger.info("job %s stages: %s" % (self.job_id, stages))
+
+
+def compact_event(data):
+    # only the event fields used by the tasks are passed along
+    event = dict((key, data[key]) for key in ('job', 'status', 'pipeline', 'description') if key in data)
+    if 'sub_id' in data.keys():
+        event['sub_id'] = data['sub_id']
+    event.setdefault('description', '')
+    return event
+
+
+def event_job_id(data):
+    if 'sub_id' in data.keys():
+        return str(data['sub_id'])
+    return str(data['job'])
+
+
+def update_job_statuses(statuses, server=None):
+    # statuses maps LAVA job ids to their latest non-terminal status. These
+    # only need to be recorded, so they are stored with one UPDATE per
+    # distinct status and never reach LAVA.
+    lava_ids = defaultdict(list)
+    for lava_id, status in statuses.items():
+        lava_ids[status].append(lava_id)
+    patterns = Pattern.objects.filter(is_active=True, **routing.server_filter(server))
+    now = timezone.now()
+    with transaction.atomic():
+        for status, ids in lava_ids.items():
+            patterns.filter(lava_job_id__in=ids).update(lava_job_status=status, last_checked_at=now)
 
 
 @celery_app.task(bind=True)
-def match_pattern(self, uuid, dt, username, data):
-    lava_id = data['job']
+def match_pattern(self, uuid, dt, username, data, server=None):
+    # server is the netloc of the LAVA server the event came from, if
+    # known; only its patterns are matched
+    lava_id = event_job_id(data)
     logger.info("matching for job: %s" % lava_id)
-    if 'sub_id' in data.keys():
-        lava_id = data['sub_id']
-    patterns = Pattern.objects.filter(is_active=True, lava_job_id=lava_id)
-    for pattern in patterns:
-        logger.info("pattern match %s" % pattern)
-        check_job_status.delay(pattern, data)
+    if data['status'] not in TERMINAL_STATES:
+        update_job_statuses({lava_id: data['status']}, server)
+        return
+    patterns = Pattern.objects.filter(is_active=True, lava_job_id=lava_id, **routing.server_filter(server))
+    pattern_ids = list(patterns.values_list('pk', flat=True))
+    if pattern_ids:
+        logger.info("pattern match %s: %s" % (lava_id, pattern_ids))
+        process_job.apply_async((pattern_ids, compact_event(data)),
+                                queue=routing.queue_for(routing.LIGHT, server))
+
 
 @celery_app.task(bind=True)
-def set_v2_testjob_results(self, pattern, data):
-    testjob = TestJob(pattern, data)
-    try:
-        test_results = get_testjob_data(testjob)
-        pattern.lava_job_status = testjob.status
-        pattern.save()
-
-        team, project, build = testjob.pattern.build_job_name.split("/")
-        squad_store_url = prepare_squad_url(settings.SQUAD_URL, team, project, build, testjob.environment)
-        result = submit_to_squad(
-            squad_url=squad_store_url,
-            team=team,
-            metrics=None,
-            tests=test_results,
-            metadata=testjob.metadata,
-            attachments={testjob.data_name: testjob.data})
-        if result:
-            testjob.pattern.is_active = False
-            testjob.pattern.save()
-
-    except testminer.LavaServerException as ex:
-        if ex.status_code / 100 == 5:
-            # HTTP 50x (internal server errors): server is too busy, in
-            # maintaince, or broken; will try again later
-            logger.info(ex.message)
-            return
+def match_pattern_batch(self, events, server=None):
+    # events is a list of (uuid, dt, username, data) tuples as received
+    # by match_pattern; all job ids are resolved with a single query
+    lava_ids = {}
+    statuses = {}
+    for uuid, dt, username, data in events:
+        lava_id = event_job_id(data)
+        if data['status'] in TERMINAL_STATES:
+            lava_ids.setdefault(lava_id, []).append(data)
         else:
+            statuses[lava_id] = data['status']
+    if statuses:
+        update_job_statuses(statuses, server)
+    if not lava_ids:
+        return
+    logger.info("matching for %d jobs" % len(lava_ids))
+    patterns = Pattern.objects.filter(is_active=True, lava_job_id__in=lava_ids.keys(),
+                                      **routing.server_filter(server))
+    pattern_ids = defaultdict(list)
+    for pk, lava_job_id in patterns.values_list('pk', 'lava_job_id'):
+        pattern_ids[lava_job_id].append(pk)
+    # the sub-jobs of a multinode job are processed together by a single
+    # task, see process_job
+    groups = OrderedDict()
+    for lava_id, ids in pattern_ids.items():
+        logger.info("pattern match %s: %s" % (lava_id, ids))
+        for data in lava_ids[lava_id]:
+            # repeated events for a job are sent once, with the patterns
+            # of all the sub-jobs of a multinode job merged
+            key = multinode_group(data) or lava_id
+            if key not in groups:
+                groups[key] = ([], data)
+            group_ids = groups[key][0]
+            group_ids.extend(pk for pk in ids if pk not in group_ids)
+    for ids, data in groups.values():
+        process_job.apply_async((ids, compact_event(data)),
+                                queue=routing.queue_for(routing.LIGHT, server))
+
+@celery_app.task(bind=True, max_retries=None)
+def process_job(self, pattern_ids, data):
+    # runs the whole pipeline for one LAVA job event: load the matched
+    # patterns, fetch and parse the results from LAVA, submit to SQUAD.
+    # Retries are not limited by Celery: an open circuit defers the job
+    # for as long as the server is down, and fetch failures are counted
+    # on their own against LAVA_FETCH_RETRIES.
+    timer = StageTimer(event_job_id(data))
+    with timer.stage('match'):
+        patterns = list(Pattern.objects.filter(pk__in=pattern_ids, is_active=True))
+    lava_id = event_job_id(data)
+    # the sub-jobs of a multinode job are leased and processed together,
+    # sharing the XML-RPC answers and parsed bundles and definitions
+    group_id = multinode_group(data)
+    by_server = OrderedDict()
+    for pattern in patterns:
+        by_server.setdefault(pattern.lava_server, []).append(pattern)
+    states = {}
+    try:
+        for lava_server, server_patterns in by_server.items():
+            with job_lease(lava_server, group_id or lava_id, lease_owner(self.request.id)) as lease:
+                if lease is None and group_id is not None:
+                    # the task holding it may have checked this sub-job
+                    # before it finished, so keep trying until the lease
+                    # is released or expires (up to LAVA_JOB_LEASE_TTL)
+                    logger.info("multinode job %s on %s is being processed" % (group_id, lava_server))
+                    raise self.retry(countdown=LEASE_RETRY_DELAY, **retry_options(self))
+                if lease is None:
+                    # another worker is on it and retries it if needed
+                    logger.info("job %s on %s is already being processed" % (lava_id, lava_server))
+                    continue
+                cache = testminer.CallCache()
+                deadline = job_deadline()
+                # pattern changes are written together before the lease
+                # is released, including the ones made before a failure
+                updates = PatternUpdates()
+                try:
+                    for pattern, job_data in group_jobs(lava_server, server_patterns, data):
+                        key = (lava_server, event_job_id(job_data))
+                        if key not in states:
+                            states[key] = fetch_state(*key)
+                        run_pipeline(pattern, job_data, timer, states[key], current_queue(self),
+                                     cache, deadline, updates)
+                finally:
+                    updates.flush()
+                if cache.hits:
+                    logger.info("job %s: %d XML-RPC calls saved" % (group_id or lava_id, cache.hits))
+    except routing.WrongQueue as ex:
+        # heavy result parsing; what was fetched so far is kept in state
+        logger.info("moving job %s to %s" % (lava_id, ex.queue))
+        process_job.apply_async((pattern_ids, data), queue=ex.queue,
+                                priority=routing.TERMINAL_PRIORITY)
+        return
+    except testminer.LavaCircuitOpenException as ex:
+        # the LAVA server is failing: park the job until the breaker lets
+        # a probe through instead of holding a worker. Patterns already
+        # submitted are inactive and skipped when the task runs again.
+        countdown = max(int(ex.retry_after), 1)
+        logger.info("%s: job %s deferred for %ds" % (ex, lava_id, countdown))
+        raise self.retry(countdown=countdown, **retry_options(self))
+    except Exception as ex:
+        if not is_failure(ex):
             raise
+        # fetch failures are counted in the fetch state rather than with
+        # request.retries, which also counts circuit and lease deferrals
+        attempts = 1
+        for state in states.values():
+            state.attempts += 1
+            if state.pk:
+                state.save(update_fields=['attempts'])
+            else:
+                state.save()
+            attempts = max(attempts, state.attempts)
+        max_retries = getattr(settings, 'LAVA_FETCH_RETRIES', 8)
+        if attempts > max_retries:
+            # the fetch state is kept, so that a later event for the job
+            # is only tried once more
+            logger.warning("%s: giving up on job %s after %d attempts" % (ex, lava_id, attempts))
+            return
+        delay = getattr(settings, 'LAVA_FETCH_RETRY_DELAY', 30)
+        countdown = min(delay * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+        logger.info("%s: retrying job %s in %ds" % (ex, lava_id, countdown))
+        raise self.retry(countdown=countdown, **retry_options(self))
+    for state in states.values():
+        if state.pk:
+            state.delete()
+    timer.report()
+
 
 @celery_app.task(bind=True)
-def set_testjob_results(self, pattern, data):
+def reconcile_patterns(self):
+    # catches up with jobs whose events were missed (listener down, ZMQ
+    # drops): one reconcile_server task per LAVA server
+    servers = Pattern.objects.filter(is_active=True).order_by().values_list('lava_server', flat=True).distinct()
+    for lava_server in servers:
+        netloc = urlsplit(lava_server).netloc
+        reconcile_server.apply_async((lava_server,), queue=routing.queue_for(routing.EVENTS, netloc))
+
+
+def due_for_check(now):
+    """
+    Q selecting the patterns whose job status is due to be polled: the
+    ones never checked, and the ones not checked for longer than the
+    interval matching their age in LAVA_RECONCILE_INTERVALS.
+    """
+    due = Q(last_checked_at__isnull=True)
+    newer_than = None
+    for max_age, interval in getattr(settings, 'LAVA_RECONCILE_INTERVALS', RECONCILE_INTERVALS):
+        age = Q(last_checked_at__lt=now - timedelta(seconds=interval))
+        if newer_than is not None:
+            age &= Q(created_at__lt=now - timedelta(seconds=newer_than))
+        if max_age is not None:
+            age &= Q(created_at__gte=now - timedelta(seconds=max_age))
+        due |= age
+        newer_than = max_age
+    return due
+
+
+@celery_app.task(bind=True)
+def reconcile_server(self, lava_server):
+    """
+    Polls the status of the active patterns of lava_server that are due,
+    LAVA_RECONCILE_BATCH jobs per system.multicall and at most
+    LAVA_RECONCILE_LIMIT per run, records it and sends the finished jobs to
+    process_job. Patterns of jobs process_job already handled, or gave up
+    on, are left alone.
+    """
+    netloc = urlsplit(lava_server).netloc
+    if netloc not in settings.CREDENTIALS.keys():
+        logger.warning("Credentials not found for %s" % netloc)
+        return
+    username, password = settings.CREDENTIALS[netloc]
+    tester = testminer.GenericLavaTestSystem(lava_server, username, password)
+    tester.throttle = server_throttle(netloc) or tester.throttle
+    tester.breaker = server_breaker(netloc) or tester.breaker
+    tester.timeouts = AdaptiveTimeouts(netloc)
+    tester.deadline = job_deadline()
+
+    now = timezone.now()
+    limit = getattr(settings, 'LAVA_RECONCILE_LIMIT', 1000)
+    batch_size = getattr(settings, 'LAVA_RECONCILE_BATCH', 100)
+    given_up = JobFetchState.objects.filter(
+        lava_server=lava_server, attempts__gt=getattr(settings, 'LAVA_FETCH_RETRIES', 8))
+    patterns = Pattern.objects.filter(is_active=True, lava_server=lava_server).filter(due_for_check(now))
+    patterns = patterns.exclude(lava_job_status__in=PROCESSED_STATES).exclude(
+        lava_job_id__in=given_up.values_list('lava_job_id', flat=True))
+    patterns = list(patterns.order_by('last_checked_at', 'pk').values_list('pk', 'lava_job_id')[:limit])
+    logger.info("reconciling %d patterns on %s" % (len(patterns), netloc))
+    finished = 0
+    for start in range(0, len(patterns), batch_size):
+        batch = patterns[start:start + batch_size]
+        job_ids = sorted(set(lava_job_id for pk, lava_job_id in batch))
+        try:
+            statuses = tester.get_test_job_statuses(job_ids)
+            done = [job_id for job_id in job_ids if statuses.get(job_id) in TERMINAL_STATES]
+            details = {}
+            if done:
+                details = dict(zip(done, tester.multicall('scheduler.job_details', [[job_id] for job_id in done])))
+        except Exception as ex:
+            if not is_failure(ex):
+                raise
+            # the next run starts again with these patterns
+            logger.warning("%s: stopped reconciling %s" % (ex, netloc))
+            break
+        with transaction.atomic():
+            Pattern.objects.filter(pk__in=[pk for pk, lava_job_id in batch]).update(last_checked_at=now)
+            update_job_statuses(dict((job_id, status) for job_id, status in statuses.items()
+                                     if status not in TERMINAL_STATES), netloc)
+        # one process_job per job, or per multinode job
+        jobs = OrderedDict()
+        for pk, lava_job_id in batch:
+            if lava_job_id not in done:
+                continue
+            job_details = details.get(lava_job_id) or {}
+            data = {
+                'job': lava_job_id,
+                'status': statuses[lava_job_id],
+                'pipeline': bool(job_details.get('is_pipeline')),
+                'description': job_details.get('description') or '',
+            }
+            if '.' in lava_job_id:
+                data['job'], data['sub_id'] = lava_job_id.split('.', 1)[0], lava_job_id
+            key = multinode_group(data) or lava_job_id
+            jobs.setdefault(key, ([], data))[0].append(pk)
+        for pks, data in jobs.values():
+            process_job.apply_async((pks, data), queue=routing.queue_for(routing.LIGHT, netloc))
+        finished += len(jobs)
+    if finished:
+        logger.info("%d finished jobs found on %s" % (finished, netloc))
+
+
+def current_queue(task):
+    # None when not run from one of the LAVA job queues, for example when
+    # called directly
+    queue = (task.request.delivery_info or {}).get('routing_key')
+    if routing.is_job_queue(queue):
+        return queue
+    return None
+
+
+def retry_options(task):
+    # retries stay on the queue the task was taken from rather than going
+    # back to the default route
+    queue = current_queue(task)
+    if queue is None:
+        return {}
+    return {'queue': queue}
+
+
+def multinode_group(data):
+    # sub-job events carry the multinode job id in 'job'
+    if 'sub_id' in data.keys():
+        return str(data['job'])
+    return None
+
+
+def group_jobs(lava_server, patterns, data):
+    """
+    (pattern, event data) pairs to process for an event. For a multinode
+    sub-job these include the active patterns of the other sub-jobs of the
+    same multinode job; the ones that are not finished yet are skipped by
+    run_pipeline.
+    """
+    group_id = multinode_group(data)
+    if group_id is None:
+        return [(pattern, data) for pattern in patterns]
+    seen = set(pattern.pk for pattern in patterns)
+    siblings = Pattern.objects.filter(is_active=True, lava_server=lava_server,
+                                      lava_job_id__startswith=group_id + '.')
+    patterns = list(patterns) + list(siblings.exclude(pk__in=seen).order_by('lava_job_id'))
+    return [(pattern, dict(data, sub_id=pattern.lava_job_id)) for pattern in patterns]
+
+
+def set_pattern(pattern, updates=None, **fields):
+    # without updates to batch them in, the changes are written at once
+    if updates is not None:
+        updates.set(pattern, **fields)
+        return
+    updates = PatternUpdates()
+    updates.set(pattern, **fields)
+    updates.flush()
+
+
+def run_pipeline(pattern, data, timer, state=None, queue=None, cache=None, deadline=None, updates=None):
+    # LAVA failures are left to process_job, which retries the job and
+    # resumes from what state already holds
     testjob = TestJob(pattern, data)
-    try:
-        test_results = get_testjob_data(testjob)
-        pattern.lava_job_status = testjob.status
-        pattern.save()
-        store_testjob_data(testjob, test_results)
-    except testminer.LavaServerException as ex:
-        if ex.status_code / 100 == 5:
-            # HTTP 50x (internal server errors): server is too busy, in
-            # maintaince, or broken; will try again later
-            logger.info(ex.message)
-            return
+    test_results = get_testjob_data(testjob, timer, state, queue, cache, deadline)
+    set_pattern(pattern, updates, lava_job_status=testjob.status)
+    if testjob.status not in TERMINAL_STATES:
+        return
+    with timer.stage('submit'):
+        if data['pipeline']:
+            store_v2_testjob_data(testjob, test_results, updates)
         else:
-            raise
+            store_testjob_data(testjob, test_results, updates)
 
 
 def prepare_squad_url(base_url, team, project, build, environment):
     split = urlsplit(base_url)
     return "%s://%s/api/submit/%s/%s/%s/%s" % (split.scheme, split.netloc, team, project, build, environment)
 
-def store_testjob_data(testjob, test_results):
+def store_v2_testjob_data(testjob, test_results, updates=None):
+    team, project, build = testjob.pattern.build_job_name.split("/")
+    squad_store_url = prepare_squad_url(settings.SQUAD_URL, team, project, build, testjob.environment)
+    result = submit_to_squad(
+        squad_url=squad_store_url,
+        team=team,
+        metrics=None,
+        tests=test_results,
+        metadata=testjob.metadata,
+        attachments={testjob.data_name: testjob.data})
+    if result:
+        set_pattern(testjob.pattern, updates, is_active=False)
+
+def store_testjob_data(testjob, test_results, updates=None):
     # stores test job data in SQUAD dashboard
     # results should be pushed to:
     # /team/project/build/environment path
@@ -189,14 +536,14 @@ def store_testjob_data(testjob, test_results):
         metadata=testjob.metadata,
         attachments={testjob.data_name: testjob.data})
     if result:
-        testjob.pattern.is_active = False
-        testjob.pattern.save()
+        set_pattern(testjob.pattern, updates, is_active=False)
 
 
 def submit_to_squad(squad_url, team, tests=None, metrics=None, metadata=None, attachments=None):
     # squad_url should be in form https://squad.example.com/api/submit/my-team/my-project/my-build/my-ci-env
     split_url = urlsplit(squad_url)
     project = split_url.path.replace("/api/submit/%s/" % team, "", 1).split("/", 1)[0]
+    build, environment = split_url.path.split("/")[5:7]
     tokens = SquadToken.objects.filter(project=project)
     if not tokens:
         logger.warning("SQUAD token not found for: %s" % project)
@@ -207,6 +554,13 @@ def submit_to_squad(squad_url, team, tests=None, metrics=None, metadata=None, at
         logger.warning("No data to submit")
         return False
 
+    key = dict(team=team, project=project, build=build, environment=environment,
+               job_id=str((metadata or {}).get('job_id')))
+    digest = payload_hash(tests, metrics, metadata, attachments)
+    if SquadSubmission.objects.filter(payload_hash=digest, **key).exists():
+        logger.info("%s already submitted to %s" % (key['job_id'], squad_url))
+        return True
+
     headers = {
         "Auth-Token": token.token
     }
@@ -241,54 +595,127 @@ def submit_to_squad(squad_url, team, tests=None, metrics=None, metadata=None, at
         logger.warning("Something went wrong")
         logger.warning(response.text)
         return False
+    SquadSubmission.objects.update_or_create(defaults={'payload_hash': digest}, **key)
     return True
 
-def get_testjob_data(testjob):
-
+def payload_hash(tests=None, metrics=None, metadata=None, attachments=None):
+    # metadata keys that change on every run without the results changing
+    volatile = ('datetime',)
+    digest = hashlib.sha256()
+    for name, value in (('tests', tests), ('metrics', metrics)):
+        digest.update(("%s:%s\n" % (name, json.dumps(value, sort_keys=True))).encode('utf-8'))
+    if metadata is not None:
+        metadata = dict((k, v) for k, v in metadata.items() if k not in volatile)
+    digest.update(("metadata:%s\n" % json.dumps(metadata, sort_keys=True)).encode('utf-8'))
+    for name, data in sorted((attachments or {}).items(), key=lambda item: str(item[0])):
+        if name is None or data is None:
+            continue
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        digest.update(("attachment:%s:%s\n" % (name, hashlib.sha256(data).hexdigest())).encode('utf-8'))
+    return digest.hexdigest()
+
+def make_tester(testjob, username, password, **attributes):
+    # attributes override the testminer defaults (throttle, breaker,
+    # cache, parser, timeouts, deadline) when not None
+    tester = getattr(testminer, testjob.testrunnerclass)(
+        testjob.testrunnerurl, username, password
+    )
+    for name, value in attributes.items():
+        if value is not None:
+            setattr(tester, name, value)
+    return tester
+
+def fetch_state(lava_server, lava_job_id):
+    # only saved once the first stage completes
+    state = JobFetchState.objects.filter(lava_server=lava_server, lava_job_id=lava_job_id).first()
+    if state is None:
+        state = JobFetchState(lava_server=lava_server, lava_job_id=lava_job_id)
+    return state
+
+def get_testjob_data(testjob, timer=None, state=None, queue=None, cache=None, deadline=None):
+    # each stage is checkpointed in state once completed, so that a retry
+    # after a LAVA failure starts from the first missing one. If queue is
+    # given, routing.WrongQueue is raised once the result class is known
+    # if the job should run on another queue.
     logger.info("Fetch benchmark results for %s" % testjob)
+    if timer is None:
+        timer = StageTimer(testjob.id)
 
     netloc = urlsplit(testjob.testrunnerurl).netloc
     if netloc not in settings.CREDENTIALS.keys():
         logger.warning("Credentials not found for %s" % netloc)
         return
+    if state is None:
+        state = fetch_state(testjob.testrunnerurl, str(testjob.id))
     username, password = settings.CREDENTIALS[netloc]
-    tester = getattr(testminer, testjob.testrunnerclass)(
-        testjob.testrunnerurl, username, password
+    attributes = dict(
+        throttle=server_throttle(netloc),
+        breaker=server_breaker(netloc),
+        cache=cache,
+        parser=parsepool.parser(),
+        # a job that failed before may need more than the usual time
+        timeouts=AdaptiveTimeouts(netloc, retry=state.attempts > 0),
+        deadline=deadline,
     )
 
-    testjob.status = tester.get_test_job_status(testjob.id)
-    testjob.url = tester.get_job_url(testjob.id)
-
-    if not testjob.initialized:
-        testjob.testrunnerclass = tester.get_result_class_name(testjob.id)
+    if state.reached('status'):
+        testjob.status = state.status
+        testjob.url = state.url
+        testjob.testrunnerclass = state.testrunnerclass
         testjob.initialized = True
-        tester = getattr(testminer, testjob.testrunnerclass)(
-            testjob.testrunnerurl, username, password
-        )
+    else:
+        tester = make_tester(testjob, username, password, **attributes)
+        with timer.stage('status'):
+            testjob.status = tester.get_test_job_status(testjob.id)
+            testjob.url = tester.get_job_url(testjob.id)
 
-    if testjob.status not in ["Complete", "Incomplete", "Canceled"]:
-        logger.debug("Job({0}) status: {1}".format(testjob.id, testjob.status))
-        return
+            if not testjob.initialized:
+                testjob.testrunnerclass = tester.get_result_class_name(testjob.id)
+                testjob.initialized = True
 
-    details = tester.get_test_job_details(testjob.id)
+        if testjob.status not in TERMINAL_STATES:
+            logger.debug("Job({0}) status: {1}".format(testjob.id, testjob.status))
+            return
+        state.checkpoint('status', status=testjob.status, url=testjob.url,
+                         testrunnerclass=testjob.testrunnerclass)
+    if queue is not None:
+        target = routing.queue_for(routing.result_cost(testjob.testrunnerclass), netloc)
+        if target != queue:
+            raise routing.WrongQueue(target)
+    tester = make_tester(testjob, username, password, **attributes)
+
+    if state.reached('details'):
+        details = json.loads(state.details)
+    else:
+        with timer.stage('details'):
+            details = tester.get_test_job_details(testjob.id)
+        metadata = details['metadata']
+
+        # update metadata to contain mandatory fields
+        #build_url: URL pointing to the origin of the build used in the test run
+        #datetime: timestamp of the test run, as a ISO-8601 date representation, with seconds. This is the representation that date --iso-8601=seconds gives you.
+        #job_id: identifier for the test run. Must be unique for the project.
+        #job_status: string identifying the status of the project. SQUAD makes no judgement about its value.
+        #job_url: URL pointing to the original test run.
+        #resubmit_url: URL that can be used to resubmit the test run.
+        metadata.update({"job_id": str(testjob.id)})
+        metadata.update({"job_status": testjob.status})
+        metadata.update({"job_url": testjob.url})
+        metadata.update({"datetime": datetime.now().isoformat()})
+        details = {
+            'definition': details['definition'],
+            'metadata': metadata,
+            'name': details['name'],
+            'environment': tester.get_environment_name(metadata),
+        }
+        state.checkpoint('details', details=json.dumps(details))
     testjob.definition = details['definition']
     testjob.metadata = details['metadata']
-
-    # update metadata to contain mandatory fields
-    #build_url: URL pointing to the origin of the build used in the test run
-    #datetime: timestamp of the test run, as a ISO-8601 date representation, with seconds. This is the representation that date --iso-8601=seconds gives you.
-    #job_id: identifier for the test run. Must be unique for the project.
-    #job_status: string identifying the status of the project. SQUAD makes no judgement about its value.
-    #job_url: URL pointing to the original test run.
-    #resubmit_url: URL that can be used to resubmit the test run.
-    testjob.metadata.update({"job_id": str(testjob.id)})
-    testjob.metadata.update({"job_status": testjob.status})
-    testjob.metadata.update({"job_url": testjob.url})
-    testjob.metadata.update({"datetime": datetime.now().isoformat()})
+    # build_url comes from the pattern, not from LAVA
     testjob.metadata.update({"build_url": testjob.pattern.build_job_url})
-
     testjob.name = details['name']
-    testjob.environment = tester.get_environment_name(testjob.metadata)
+    testjob.environment = details['environment']
     testjob.completed = True
     logger.debug("Test job({0}) completed: {1}".format(testjob.id, testjob.completed))
     if testjob.status in ["Incomplete", "Canceled"]:
@@ -299,19 +726,30 @@ def get_testjob_data(testjob):
     logger.debug("Tester class:{0}".format(tester.__class__.__name__))
     logger.debug("Testjob:{0}".format(testjob.id))
 
-    test_results = tester.get_test_job_results(testjob.id)
+    if state.reached('results'):
+        test_results = json.loads(state.results)
+    else:
+        with timer.stage('results'):
+            test_results = tester.get_test_job_results(testjob.id)
+        state.checkpoint('results', results=json.dumps(test_results))
 
     if not test_results and testjob.testrunnerclass != "GenericLavaTestSystem":
         testjob.status = "Results Missing"
         return
 
-    datafile_name, datafile_content = tester.get_result_data(testjob.id)
+    if state.reached('data'):
+        datafile_name, datafile_content = state.data_name, state.data
+        if datafile_content is not None:
+            datafile_content = bytes(datafile_content)
+    else:
+        with timer.stage('data'):
+            datafile_name, datafile_content = tester.get_result_data(testjob.id)
+        state.checkpoint('data', data_name=datafile_name, data=datafile_content)
 
     if datafile_name and datafile_content:
         #datafile = ContentFile(datafile_content)
         #testjob.data.save(datafile_name, datafile, save=False)
-        datafile = StrinIO(datafile_content)
-        testjob.data = datafile
+        testjob.data = datafile_content
         testjob.data_name = datafile_name
 
     tester.cleanup()
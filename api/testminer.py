@@ -9,6 +9,7 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import time
 import yaml
 
 try:
@@ -22,6 +23,7 @@ try:
 except ImportError:
     from urlparse import urlsplit
 
+from contextlib import contextmanager
 from copy import deepcopy
 from subprocess import Popen, PIPE, STDOUT
 from celery.utils.log import get_task_logger
@@ -35,6 +37,64 @@ except ImportError:
     DEVNULL = open(os.devnull, 'wb')
 
 
+class NoThrottle(object):
+    """
+    Lets every call through; replaced per instance by api.throttle when
+    LAVA_THROTTLE_DIR is set.
+    """
+
+    @contextmanager
+    def slot(self, deadline=None):
+        yield
+
+
+class NoBreaker(object):
+    """
+    Never opens; replaced per instance by api.breaker when LAVA_BREAKER_DIR
+    is set.
+    """
+
+    @contextmanager
+    def call(self):
+        yield
+
+
+class CallCache(object):
+    """
+    Remembers the answers to XML-RPC calls that don't change once a job
+    has finished, and the parsed content of those answers, so that the
+    testers working on one job, or on the sub-jobs of a multinode job,
+    fetch and parse each of them only once.
+    """
+    METHODS = ('scheduler.job_status', 'scheduler.job_details', 'dashboard.get')
+
+    def __init__(self):
+        self.calls = {}
+        self.parsed = {}
+        self.hits = 0
+        self.misses = 0
+
+    def call(self, method_name, method_params, fetch):
+        if method_name not in self.METHODS:
+            return fetch()
+        key = (method_name, repr(method_params))
+        if key in self.calls:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.calls[key] = fetch()
+        return self.calls[key]
+
+    def parse(self, loader, content, load=None):
+        key = (loader, content)
+        if key not in self.parsed:
+            if load is None:
+                self.parsed[key] = loader(content)
+            else:
+                self.parsed[key] = load(loader, content)
+        return self.parsed[key]
+
+
 def extract_metadata(definition):
     parser = MetadataParser(definition)
     return parser.metadata
@@ -198,6 +258,29 @@ class LavaServerException(Exception):
         super(Exception, self).__init__(message)
 
 
+class LavaCircuitOpenException(LavaServerException):
+    """
+    Raised without contacting the server while its circuit breaker is
+    open; retry_after is the number of seconds until the next probe.
+    """
+    def __init__(self, url, retry_after):
+        self.retry_after = retry_after
+        self.status_code = 503
+        message = "circuit open for %s, next probe in %ds" % (url, retry_after)
+        super(LavaServerException, self).__init__(message)
+
+
+class LavaDeadlineException(LavaServerException):
+    """
+    Raised when the deadline of the job being processed has passed, either
+    before calling the server or during a call whose timeout it shortened.
+    """
+    def __init__(self, url, method_name):
+        self.status_code = 504
+        message = "deadline reached waiting for %s on %s" % (method_name, url)
+        super(LavaServerException, self).__init__(message)
+
+
 class LavaResponseException(Exception):
     pass
 
@@ -206,6 +289,16 @@ class GenericLavaTestSystem(TestSystem):
     XMLRPC = 'RPC2/'
     BUNDLESTREAMS = 'dashboard/streams'
     JOB = 'scheduler/job'
+    throttle = NoThrottle()
+    breaker = NoBreaker()
+    cache = None
+    parser = None
+    # timeouts, when set, picks the timeout of each call and is told how
+    # long they took; deadline, when set, caps every timeout to the time
+    # remaining for the job
+    timeouts = None
+    deadline = None
+    TIMEOUT = 100
     def __init__(self, base_url, username=None, password=None, repo_prefix=None):
         base_url_split = urlsplit(base_url)
         self.url = "%s://%s/" % (base_url_split.scheme, base_url_split.netloc)
@@ -227,6 +320,31 @@ class GenericLavaTestSystem(TestSystem):
         result = self.call_xmlrpc("scheduler.job_status", job_id)
         return result['job_status']
 
+    def multicall(self, method_name, params_list):
+        """
+        Calls method_name once per entry of params_list, in a single
+        system.multicall request when the server supports it, and returns
+        the answers in the same order; None stands for a fault.
+        """
+        calls = [{'methodName': method_name, 'params': list(params)} for params in params_list]
+        try:
+            answers = self.call_xmlrpc('system.multicall', calls)
+        except LavaResponseException as e:
+            logger.debug("system.multicall failed, calling one by one: %s" % e)
+            answers = []
+            for params in params_list:
+                try:
+                    answers.append([self.call_xmlrpc(method_name, *params)])
+                except LavaResponseException:
+                    answers.append(None)
+        # successful calls are wrapped in a one item list, faults are dicts
+        return [answer[0] if isinstance(answer, list) and answer else None for answer in answers]
+
+    def get_test_job_statuses(self, job_ids):
+        answers = self.multicall("scheduler.job_status", [[job_id] for job_id in job_ids])
+        return dict((job_id, answer['job_status']) for job_id, answer in zip(job_ids, answers)
+                    if answer is not None)
+
     def get_test_job_details(self, job_id):
         """
         returns test job metadata, for example device type
@@ -254,7 +372,7 @@ class GenericLavaTestSystem(TestSystem):
     def get_result_class_name(self, job_id):
         content = self.call_xmlrpc('scheduler.job_details', job_id)
         if content['is_pipeline']:
-            definition = yaml.load(content['definition'])
+            definition = self.parse(yaml.load, content['definition'])
         else:
             definition = json.loads(content['definition'])
         return self.get_result_class_name_from_definition(definition)
@@ -277,27 +395,78 @@ class GenericLavaTestSystem(TestSystem):
                                 return "AndroidCtsTestResults"
         return "GenericLavaTestSystem"
 
+    def load(self, loader, content):
+        # parser, when set, may run loader in another process
+        if self.parser is None:
+            return loader(content)
+        return self.parser.parse(loader, content)
+
+    def parse(self, loader, content):
+        if self.cache is None:
+            return self.load(loader, content)
+        return self.cache.parse(loader, content, self.load)
+
     def call_xmlrpc(self, method_name, *method_params):
+        if self.cache is None:
+            return self.send_xmlrpc(method_name, *method_params)
+        return self.cache.call(method_name, method_params,
+                               lambda: self.send_xmlrpc(method_name, *method_params))
+
+    def call_timeout(self, method_name):
+        """
+        Returns the timeout for a call and whether the deadline shortened
+        it; raises LavaDeadlineException if the deadline has passed.
+        """
+        timeout = self.TIMEOUT
+        if self.timeouts is not None:
+            timeout = self.timeouts.timeout(method_name)
+        if self.deadline is not None:
+            remaining = self.deadline.remaining()
+            if remaining <= 0:
+                raise LavaDeadlineException(self.xmlrpc_url, method_name)
+            if remaining < timeout:
+                return remaining, True
+        return timeout, False
+
+    def send_xmlrpc(self, method_name, *method_params):
         payload = xmlrpclib.dumps((method_params), method_name)
 
         logger.debug(self.xmlrpc_url)
-        response = requests.request('POST', self.xmlrpc_url,
-                                    data = payload,
-                                    headers = {'Content-Type': 'application/xml'},
-                                    auth = (self.username, self.password),
-                                    timeout = 100,
-                                    stream = False)
-
-        if response.status_code == 200:
-            try:
-                result = xmlrpclib.loads(response.content)[0][0]
-                return result
-            except xmlrpclib.Fault as e:
-                message = "Fault code: %d, Fault string: %s\n %s" % (
-                    e.faultCode, e.faultString, payload)
-                raise LavaResponseException(message)
-        else:
-            raise LavaServerException(self.xmlrpc_url, response.status_code)
+        # checked before the breaker too, so that a job out of time does
+        # not take the probe of a half-open circuit
+        self.call_timeout(method_name)
+        with self.breaker.call():
+            with self.throttle.slot(self.deadline):
+                # the time spent waiting for the slot counts
+                timeout, shortened = self.call_timeout(method_name)
+                start = time.time()
+                try:
+                    response = requests.request('POST', self.xmlrpc_url,
+                                                data = payload,
+                                                headers = {'Content-Type': 'application/xml'},
+                                                auth = (self.username, self.password),
+                                                timeout = timeout,
+                                                stream = False)
+                except requests.Timeout:
+                    # running out of the job's time says nothing about
+                    # how long the call takes
+                    if shortened:
+                        raise LavaDeadlineException(self.xmlrpc_url, method_name)
+                    if self.timeouts is not None:
+                        self.timeouts.observe(method_name, timeout, timed_out=True)
+                    raise
+            if response.status_code != 200:
+                raise LavaServerException(self.xmlrpc_url, response.status_code)
+        if self.timeouts is not None:
+            self.timeouts.observe(method_name, time.time() - start)
+
+        try:
+            result = xmlrpclib.loads(response.content)[0][0]
+            return result
+        except xmlrpclib.Fault as e:
+            message = "Fault code: %d, Fault string: %s\n %s" % (
+                e.faultCode, e.faultString, payload)
+            raise LavaResponseException(message)
 
     def get_environment_name(self, metadata):
         return metadata.get('device')
@@ -318,9 +487,9 @@ class LavaV2TestSystem(GenericLavaTestSystem):
         if 'bundle_sha1' in status:
             details.update({"bundle": status['bundle_sha1']})
         content = self.call_xmlrpc('scheduler.job_details', job_id)
-        definition = yaml.load(content['definition'])
+        definition = self.parse(yaml.load, content['definition'])
         if content['multinode_definition']:
-            definition = yaml.load(content['multinode_definition'])
+            definition = self.parse(yaml.load, content['multinode_definition'])
         details.update({"definition": str(yaml.dump(definition))}) # keep json?
         details['metadata'] = extract_metadata(definition)
         details['metadata']['device'] = extract_device(definition)
@@ -342,7 +511,7 @@ class LavaV2PassFailTestSystem(LavaV2TestSystem):
     def get_test_job_results(self, job_id):
         ret_results = {}
         results = self.call_xmlrpc('results.get_testjob_results_yaml', job_id)
-        for result in yaml.load(results):
+        for result in self.parse(yaml.load, results):
             if result['suite'] != 'lava':
                 suite = result['suite'].split("_", 1)[1]
                 res_name = "%s/%s" % (suite, result['name'])
@@ -553,7 +722,7 @@ class LavaTestSystem(GenericLavaTestSystem):
 
         if sha1:
             result_bundle = self.call_xmlrpc('dashboard.get', sha1)
-            bundle = json.loads(result_bundle['content'])
+            bundle = self.parse(json.loads, result_bundle['content'])
             for run in iter(bundle['test_runs']):
                 test_results = run['test_results']
                 if run['test_id'] != 'lava':
@@ -719,7 +888,7 @@ class ArtMicrobenchmarksTestResults(LavaTestSystem):
 
         sha1 = status['bundle_sha1']
         result_bundle = self.call_xmlrpc('dashboard.get', sha1)
-        bundle = json.loads(result_bundle['content'])
+        bundle = self.parse(json.loads, result_bundle['content'])
 
         host = [t for t in bundle['test_runs'] if t['test_id'] == 'art-microbenchmarks']
         if host:
@@ -730,7 +899,7 @@ class ArtMicrobenchmarksTestResults(LavaTestSystem):
 
         if not json_attachments:
             return (None, None)
-        return (json_attachments[0][0], base64.b64decode(json_attachments[0][1]))
+        return (json_attachments[0][0], self.load(base64.b64decode, json_attachments[0][1]))
 
     def get_environment_name(self, metadata):
         wanted = ('device', 'mode', 'core', 'compiler-mode')
@@ -789,7 +958,7 @@ class ArtWATestResults(LavaTestSystem):
 
         sha1 = status['bundle_sha1']
         result_bundle = self.call_xmlrpc('dashboard.get', sha1)
-        bundle = json.loads(result_bundle['content'])
+        bundle = self.parse(json.loads, result_bundle['content'])
 
         host = [t for t in bundle['test_runs'] if t['test_id'] == 'wa2-host-postprocessing']
         if host:
@@ -800,7 +969,7 @@ class ArtWATestResults(LavaTestSystem):
 
         if not db_attachments:
             return (None, None)
-        return (db_attachments[0][0], base64.b64decode(db_attachments[0][1]))
+        return (db_attachments[0][0], self.load(base64.b64decode, db_attachments[0][1]))
 
 
 class AndroidMultinodeBenchmarkResults(LavaTestSystem):
@@ -820,7 +989,7 @@ class AndroidMultinodeBenchmarkResults(LavaTestSystem):
 
         sha1 = status['bundle_sha1']
         result_bundle = self.call_xmlrpc('dashboard.get', sha1)
-        bundle = json.loads(result_bundle['content'])
+        bundle = self.parse(json.loads, result_bundle['content'])
 
         target = [t for t in bundle['test_runs'] if t['test_id'] in ['multinode-target', 'lava-android-benchmark-target', 'target-stop']]
         if target:
@@ -1,3 +1,320 @@
-from django.test import TestCase
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import requests
 
-# Create your tests here.
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api import parsepool
+from api.breaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN, is_failure, server_breaker
+from api.lease import acquire, job_lease, release
+from api.models import JobLease
+from api.testminer import LavaServerException, LavaCircuitOpenException, LavaDeadlineException
+from api.throttle import ServerThrottle
+from api.timeouts import Deadline
+from api.views import CallbackViewSet
+from listener.dispatch import EventDispatcher
+
+try:
+    import eventlet
+except ImportError:
+    eventlet = None
+
+URL = 'https://lava.example.com/RPC2/'
+
+
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def breaker(self, failures=2, reset=60):
+        return CircuitBreaker('lava.example.com:443', self.directory, failures, reset)
+
+    def fail(self, breaker, exception=None):
+        try:
+            with breaker.call():
+                raise exception or LavaServerException(URL, 502)
+        except LavaCircuitOpenException:
+            raise
+        except Exception:
+            pass
+
+    def succeed(self, breaker):
+        with breaker.call():
+            pass
+
+    def state(self, breaker):
+        with breaker.locked_state() as state:
+            return state['state']
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = self.breaker()
+        self.fail(breaker)
+        self.assertEqual(CLOSED, self.state(breaker))
+        self.fail(breaker)
+        self.assertEqual(OPEN, self.state(breaker))
+        with self.assertRaises(LavaCircuitOpenException):
+            self.succeed(breaker)
+
+    def test_success_resets_failures(self):
+        breaker = self.breaker()
+        self.fail(breaker)
+        self.succeed(breaker)
+        self.fail(breaker)
+        self.assertEqual(CLOSED, self.state(breaker))
+
+    def test_client_errors_are_not_failures(self):
+        breaker = self.breaker()
+        self.fail(breaker, LavaServerException(URL, 404))
+        self.fail(breaker, LavaServerException(URL, 404))
+        self.assertEqual(CLOSED, self.state(breaker))
+
+    def test_deadline_is_not_a_failure(self):
+        breaker = self.breaker()
+        self.fail(breaker, LavaDeadlineException(URL, 'dashboard.get'))
+        self.fail(breaker, LavaDeadlineException(URL, 'dashboard.get'))
+        self.assertEqual(CLOSED, self.state(breaker))
+
+    def test_successful_probe_closes(self):
+        breaker = self.breaker(reset=0)
+        self.fail(breaker)
+        self.fail(breaker)
+        breaker.before_call()
+        self.assertEqual(HALF_OPEN, self.state(breaker))
+        breaker.record(False)
+        self.assertEqual(CLOSED, self.state(breaker))
+
+    def test_failed_probe_opens_again(self):
+        breaker = self.breaker(failures=2, reset=0)
+        self.fail(breaker)
+        self.fail(breaker)
+        breaker.before_call()
+        breaker.record(True)
+        self.assertEqual(OPEN, self.state(breaker))
+
+    def test_state_is_shared(self):
+        self.fail(self.breaker())
+        self.fail(self.breaker())
+        with self.assertRaises(LavaCircuitOpenException):
+            self.succeed(self.breaker())
+
+    def test_is_failure(self):
+        self.assertTrue(is_failure(LavaServerException(URL, 500)))
+        self.assertTrue(is_failure(requests.Timeout()))
+        self.assertTrue(is_failure(requests.ConnectionError()))
+        self.assertFalse(is_failure(LavaServerException(URL, 403)))
+        self.assertFalse(is_failure(ValueError()))
+
+    def test_server_breaker_limits(self):
+        self.assertIsNone(server_breaker('lava.example.com'))
+        config = {'default': {'failures': 3}, 'lava.example.com': {'reset': 10}}
+        with override_settings(LAVA_BREAKER_DIR=self.directory, LAVA_BREAKER=config):
+            breaker = server_breaker('lava.example.com')
+        self.assertEqual(3, breaker.failures)
+        self.assertEqual(10, breaker.reset)
+
+
+SERVER = 'https://lava.example.com/'
+
+
+class JobLeaseTest(TestCase):
+
+    def test_held_lease_is_not_acquired(self):
+        lease = acquire(SERVER, '123', 'worker-1', 60)
+        self.assertEqual('worker-1', lease.owner)
+        self.assertIsNone(acquire(SERVER, '123', 'worker-2', 60))
+
+    def test_leases_are_per_job_and_server(self):
+        acquire(SERVER, '123', 'worker-1', 60)
+        self.assertIsNotNone(acquire(SERVER, '124', 'worker-2', 60))
+        self.assertIsNotNone(acquire('https://other.example.com/', '123', 'worker-2', 60))
+
+    def test_expired_lease_is_taken_over(self):
+        now = timezone.now()
+        JobLease.objects.create(lava_server=SERVER, lava_job_id='123', owner='dead',
+                                acquired_at=now - timedelta(seconds=120),
+                                expires_at=now - timedelta(seconds=60))
+        lease = acquire(SERVER, '123', 'worker-1', 60)
+        self.assertEqual('worker-1', lease.owner)
+        self.assertIsNone(acquire(SERVER, '123', 'worker-2', 60))
+
+    def test_release_after_takeover_keeps_new_lease(self):
+        old = acquire(SERVER, '123', 'worker-1', 60)
+        JobLease.objects.filter(pk=old.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+        acquire(SERVER, '123', 'worker-2', 60)
+        release(old)
+        self.assertEqual(['worker-2'], list(JobLease.objects.values_list('owner', flat=True)))
+
+    def test_job_lease_is_released_on_exit(self):
+        with job_lease(SERVER, '123', 'worker-1') as lease:
+            self.assertIsNotNone(lease)
+            with job_lease(SERVER, '123', 'worker-2') as other:
+                self.assertIsNone(other)
+        self.assertFalse(JobLease.objects.exists())
+
+    def test_job_lease_is_released_on_error(self):
+        with self.assertRaises(ValueError):
+            with job_lease(SERVER, '123', 'worker-1'):
+                raise ValueError()
+        self.assertFalse(JobLease.objects.exists())
+
+
+# three greenlets sharing one slot in an eventlet worker; killed by the
+# alarm if the hub gets blocked
+GREEN_SLOTS = """
+import eventlet
+eventlet.monkey_patch()
+import signal, sys, time
+from api.throttle import ServerThrottle
+signal.alarm(20)
+throttle = ServerThrottle('lava.example.com', sys.argv[1], 1, 0, 1)
+done = []
+def call(i):
+    with throttle.slot():
+        time.sleep(0.05)
+    done.append(i)
+pool = eventlet.GreenPool()
+for i in range(3):
+    pool.spawn(call, i)
+pool.waitall()
+sys.exit(0 if len(done) == 3 else 1)
+"""
+
+
+class ServerThrottleTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_concurrency_limit(self):
+        throttle = ServerThrottle('lava.example.com', self.directory, 2, 0, 1)
+        lock = threading.Lock()
+        active = []
+        peak = []
+
+        def call():
+            with throttle.slot():
+                with lock:
+                    active.append(1)
+                    peak.append(len(active))
+                time.sleep(0.05)
+                with lock:
+                    active.pop()
+
+        threads = [threading.Thread(target=call) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(5, len(peak))
+        self.assertLessEqual(max(peak), 2)
+
+    def test_deadline_while_waiting(self):
+        throttle = ServerThrottle('lava.example.com', self.directory, 1, 0, 1)
+        with throttle.slot():
+            with self.assertRaises(LavaDeadlineException):
+                with throttle.slot(Deadline(0.2)):
+                    pass
+
+    @unittest.skipIf(eventlet is None, "eventlet is not installed")
+    def test_more_greenlets_than_slots(self):
+        returncode = subprocess.call([sys.executable, '-c', GREEN_SLOTS, self.directory],
+                                     cwd=settings.BASE_DIR)
+        self.assertEqual(0, returncode)
+
+
+# parse pool used from greenlets of a monkey-patched process; killed by
+# the alarm if it hangs
+GREEN_PARSE = """
+import eventlet
+eventlet.monkey_patch()
+import json, signal, sys
+from api.parsepool import ParsePool
+signal.alarm(20)
+pool = ParsePool(2, min_size=1)
+green = eventlet.GreenPool()
+results = list(green.imap(lambda i: pool.parse(json.loads, '[%d]' % i)[0], range(10)))
+pool.close()
+sys.exit(0 if results == list(range(10)) else 1)
+"""
+
+
+class ParsePoolTest(TestCase):
+
+    def setUp(self):
+        self.pool = parsepool.ParsePool(1, min_size=1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_parse(self):
+        self.assertEqual({'a': [1, 2]}, self.pool.parse(json.loads, '{"a": [1, 2]}'))
+
+    def test_loader_errors_are_raised(self):
+        with self.assertRaises(ValueError):
+            self.pool.parse(json.loads, '{not json')
+        self.assertEqual([1], self.pool.parse(json.loads, '[1]'))
+
+    def test_dead_parser_is_replaced(self):
+        process = self.pool.idle.queue[0]
+        process.process.kill()
+        process.process.wait()
+        self.assertEqual([1], self.pool.parse(json.loads, '[1]'))
+        self.assertEqual([2], self.pool.parse(json.loads, '[2]'))
+        self.assertIsNot(process, self.pool.idle.queue[0])
+
+    @unittest.skipIf(eventlet is None, "eventlet is not installed")
+    def test_parse_from_greenlets(self):
+        returncode = subprocess.call([sys.executable, '-c', GREEN_PARSE], cwd=settings.BASE_DIR)
+        self.assertEqual(0, returncode)
+
+
+@override_settings(LISTENER_PREFILTER=False, LISTENER_DEDUPE_TTL=300)
+class ConcurrentCallbackTest(TestCase):
+
+    def setUp(self):
+        CallbackViewSet.index = CallbackViewSet.dedupe = None
+        self.sent = []
+        self.send = EventDispatcher.send
+        EventDispatcher.send = lambda dispatcher, task_name, count, args, priority=None: self.sent.append(args)
+
+    def tearDown(self):
+        EventDispatcher.send = self.send
+        CallbackViewSet.index = CallbackViewSet.dedupe = None
+
+    def test_repeated_event_from_many_threads_is_sent_once(self):
+        view = CallbackViewSet.as_view({'post': 'create'})
+        factory = APIRequestFactory()
+        user = User(username='lava')
+        event = {'job': '123', 'status': 'Complete', 'pipeline': True}
+        statuses = []
+
+        def post():
+            request = factory.post('/api/callback/', event, format='json')
+            force_authenticate(request, user=user)
+            statuses.append(view(request).status_code)
+
+        threads = [threading.Thread(target=post) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([202] * 10, statuses)
+        self.assertEqual(1, len(self.sent))
@@ -0,0 +1,143 @@
+"""
+Per LAVA server rate and concurrency limits shared by all the workers of a
+host.
+
+The state lives in lock files under LAVA_THROTTLE_DIR: callers take turns
+on the "<server>.queue" lock to take a token from the bucket kept in
+"<server>.bucket" and then one of the "<server>.slot.N" locks, which they
+hold for the duration of the call. Locks are polled every poll_interval
+seconds rather than waited for in flock, which would block every greenlet
+of an eventlet worker, including the one holding the slot being waited
+for. Callers are therefore not served first come first served; the queue
+lock only keeps a caller that found no token or slot from being overtaken
+by one arriving while it waits.
+"""
+import fcntl
+import logging
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from listener import metrics
+from .serverstate import server_limits, state_path
+from .testminer import LavaDeadlineException
+
+logger = logging.getLogger(__name__)
+
+WAIT_SECONDS = metrics.REGISTRY.histogram(
+    'lava_throttle_wait_seconds',
+    'Time spent waiting for a LAVA call slot, per server',
+    ['server'])
+CALLS = metrics.REGISTRY.counter(
+    'lava_throttle_calls_total',
+    'LAVA calls that went through the throttle, per server',
+    ['server'])
+
+DEFAULT_LIMITS = {
+    'concurrency': 4,  # calls in flight at the same time
+    'rate': 10.0,      # sustained calls per second
+    'burst': 10,       # calls allowed at once after being idle
+}
+
+
+class ServerThrottle(object):
+
+    poll_interval = 0.05
+
+    def __init__(self, netloc, directory, concurrency, rate, burst):
+        self.netloc = netloc
+        self.concurrency = max(int(concurrency), 1)
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.path = state_path(directory, netloc)
+
+    def take_token(self):
+        """
+        Takes a token from the bucket, returning 0, or returns the number
+        of seconds until one is available. Only called with the queue lock
+        held.
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.time()
+        tokens, updated = self.burst, now
+        try:
+            with open(self.path + '.bucket') as f:
+                tokens, updated = [float(v) for v in f.read().split()]
+        except (IOError, ValueError):
+            pass
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        with open(self.path + '.bucket', 'w') as f:
+            f.write("%f %f" % (tokens, now))
+        return wait
+
+    def try_lock(self, f):
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError:
+            return False
+
+    def take_slot(self):
+        for i in range(self.concurrency):
+            f = open("%s.slot.%d" % (self.path, i), 'a')
+            if self.try_lock(f):
+                return f
+            f.close()
+        return None
+
+    def sleep(self, seconds, deadline):
+        if deadline is not None and deadline.remaining() <= seconds:
+            raise LavaDeadlineException(self.netloc, 'a call slot')
+        time.sleep(seconds)
+
+    @contextmanager
+    def slot(self, deadline=None):
+        """
+        Holds a call slot; raises LavaDeadlineException if deadline passes
+        while waiting for one.
+        """
+        start = time.time()
+        with open(self.path + '.queue', 'a') as queue:
+            while not self.try_lock(queue):
+                self.sleep(self.poll_interval, deadline)
+            try:
+                wait = self.take_token()
+                while wait:
+                    self.sleep(wait, deadline)
+                    wait = self.take_token()
+                slot = self.take_slot()
+                while slot is None:
+                    self.sleep(self.poll_interval, deadline)
+                    slot = self.take_slot()
+            finally:
+                fcntl.flock(queue, fcntl.LOCK_UN)
+        waited = time.time() - start
+        WAIT_SECONDS.observe(waited, server=self.netloc)
+        CALLS.inc(server=self.netloc)
+        if waited > 1:
+            logger.info("waited %.1fs for a call slot on %s" % (waited, self.netloc))
+        try:
+            yield
+        finally:
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            slot.close()
+
+
+def server_throttle(netloc):
+    """
+    Returns the throttle for a LAVA server, or None if LAVA_THROTTLE_DIR is
+    not set. Limits come from LAVA_THROTTLE[netloc], falling back to
+    LAVA_THROTTLE['default'] and then DEFAULT_LIMITS.
+    """
+    directory = getattr(settings, 'LAVA_THROTTLE_DIR', None)
+    if not directory:
+        return None
+    return ServerThrottle(netloc, directory, **server_limits('LAVA_THROTTLE', netloc, DEFAULT_LIMITS))
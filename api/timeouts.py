@@ -0,0 +1,96 @@
+"""
+Deadlines and latency based timeouts for LAVA XML-RPC calls.
+
+Each worker process keeps the latency of the last successful calls per
+server and method. The timeout of a call is a multiple of the observed
+LAVA_TIMEOUT_PERCENTILE, kept between LAVA_TIMEOUT_MIN and LAVA_TIMEOUT_MAX
+seconds, so that a quick scheduler.job_status doesn't wait as long as a
+large dashboard.get when a server stops answering. Until enough calls
+have been seen, LAVA_TIMEOUT_MAX is used.
+
+Calls that time out are counted as taking their timeout, so that the
+timeouts grow again when a server gets slower, and the calls made when
+retrying a job that failed always get LAVA_TIMEOUT_MAX, so that an answer
+slower than the usual ones is not missed on every attempt.
+"""
+import threading
+import time
+
+from collections import defaultdict, deque
+
+from django.conf import settings
+
+from listener import metrics
+
+CALL_SECONDS = metrics.REGISTRY.histogram(
+    'lava_call_seconds',
+    'Duration of successful LAVA XML-RPC calls, per server and method',
+    ['server', 'method'])
+
+SAMPLES = 200
+MIN_SAMPLES = 20
+
+
+class Deadline(object):
+
+    def __init__(self, seconds):
+        self.expires_at = time.time() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+
+class LatencyTracker(object):
+
+    def __init__(self, size=SAMPLES):
+        self.samples = defaultdict(lambda: deque(maxlen=size))
+        self.lock = threading.Lock()
+
+    def observe(self, key, seconds):
+        with self.lock:
+            self.samples[key].append(seconds)
+
+    def percentile(self, key, q, min_samples=MIN_SAMPLES):
+        with self.lock:
+            samples = sorted(self.samples.get(key, ()))
+        if len(samples) < min_samples:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+TRACKER = LatencyTracker()
+
+
+class AdaptiveTimeouts(object):
+    """
+    Timeouts for the calls to one LAVA server.
+    """
+
+    def __init__(self, netloc, tracker=TRACKER, retry=False):
+        self.netloc = netloc
+        self.tracker = tracker
+        self.retry = retry
+        self.minimum = getattr(settings, 'LAVA_TIMEOUT_MIN', 5)
+        self.maximum = getattr(settings, 'LAVA_TIMEOUT_MAX', 100)
+        self.percentile = getattr(settings, 'LAVA_TIMEOUT_PERCENTILE', 0.99)
+        self.factor = getattr(settings, 'LAVA_TIMEOUT_FACTOR', 3)
+
+    def timeout(self, method_name):
+        if self.retry:
+            return self.maximum
+        latency = self.tracker.percentile((self.netloc, method_name), self.percentile)
+        if latency is None:
+            return self.maximum
+        return max(self.minimum, min(self.maximum, latency * self.factor))
+
+    def observe(self, method_name, seconds, timed_out=False):
+        self.tracker.observe((self.netloc, method_name), seconds)
+        if not timed_out:
+            CALL_SECONDS.observe(seconds, server=self.netloc, method=method_name)
+
+
+def job_deadline():
+    seconds = getattr(settings, 'LAVA_JOB_DEADLINE', 600)
+    if not seconds:
+        return None
+    return Deadline(seconds)
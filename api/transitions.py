@@ -0,0 +1,51 @@
+"""
+Pattern state changes made by the pipeline.
+
+Changes are collected with set() and written by flush() in a single
+transaction, with one UPDATE per distinct set of changed fields rather
+than a save() of every column per pattern. This keeps SQLite write locks
+short when many workers finish jobs at the same time, and a stale
+instance never overwrites fields it did not change.
+
+A PatternUpdates lives for one process_job: the patterns of a job, or of
+the sub-jobs of a multinode job, are written together, but changes of
+different jobs are not batched in one transaction, as each job's changes
+have to be written before its lease is released.
+"""
+from collections import OrderedDict
+
+from django.db import transaction
+
+from .models import Pattern
+
+
+class PatternUpdates(object):
+
+    def __init__(self):
+        self.changes = OrderedDict()
+
+    def __len__(self):
+        return len(self.changes)
+
+    def set(self, pattern, **fields):
+        """
+        Records new field values for pattern and applies them to the
+        instance; values equal to the instance ones are ignored.
+        """
+        for name, value in fields.items():
+            if getattr(pattern, name) == value and name not in self.changes.get(pattern.pk, {}):
+                continue
+            setattr(pattern, name, value)
+            self.changes.setdefault(pattern.pk, {})[name] = value
+
+    def flush(self):
+        if not self.changes:
+            return
+        pks = OrderedDict()
+        for pk, fields in self.changes.items():
+            key = tuple(sorted(fields.items()))
+            pks.setdefault(key, []).append(pk)
+        self.changes = OrderedDict()
+        with transaction.atomic():
+            for key, ids in pks.items():
+                Pattern.objects.filter(pk__in=ids).update(**dict(key))
@@ -6,6 +6,7 @@ from . import views
 
 router = routers.DefaultRouter()
 router.register('pattern', views.PatternViewSet)
+router.register('callback', views.CallbackViewSet, base_name='callback')
 
 urlpatterns = [
         url(r'^', include(router.urls)),
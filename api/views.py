@@ -1,4 +1,8 @@
+import threading
+
+from django.conf import settings
 from django.shortcuts import render
+from django.utils import timezone
 
 from rest_framework import response
 from rest_framework import status
@@ -6,7 +10,9 @@ from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated, DjangoModelPermissions
 
 from api.models import Pattern
-from api.serializers import PatternSerializer
+from api.serializers import LavaEventSerializer, PatternSerializer
+from listener.dispatch import EventDispatcher, default_dedupe
+from listener.prefilter import PatternIndex
 
 class PatternViewSet(viewsets.ModelViewSet):
     permission_classes = [DjangoModelPermissions]
@@ -26,3 +32,53 @@ class PatternViewSet(viewsets.ModelViewSet):
         else:
             return response.Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         return response.Response("{}", status=status.HTTP_401_UNAUTHORIZED)
+
+
+class CallbackViewSet(viewsets.ViewSet):
+    """
+    Receives LAVA job notifications pushed over HTTP, either a single event
+    or a JSON array of events, and feeds them to the same matching pipeline
+    as the ZMQ listener, with the same prefiltering and deduplication.
+    """
+    permission_classes = [IsAuthenticated]
+
+    # shared by the requests of all threads; both lock their own state
+    index = None
+    dedupe = None
+    setup_lock = threading.Lock()
+
+    @classmethod
+    def setup(cls):
+        with cls.setup_lock:
+            if cls.index is None and getattr(settings, 'LISTENER_PREFILTER', True):
+                index = PatternIndex()
+                index.rebuild()
+                cls.index = index
+            if cls.dedupe is None:
+                cls.dedupe = default_dedupe()
+
+    def create(self, request, *args, **kwargs):
+        events = request.data
+        if not isinstance(events, list):
+            events = [events]
+        serializer = LavaEventSerializer(data=events, many=True)
+        if not serializer.is_valid():
+            return response.Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        self.setup()
+        dt = timezone.now().isoformat()
+        dispatchers = {}
+        for event in serializer.validated_data:
+            event = dict(event)
+            lava_server = event.pop('lava_server', None)
+            if lava_server not in dispatchers:
+                dispatchers[lava_server] = EventDispatcher(
+                    lava_server,
+                    batch_size=len(events),
+                    index=self.index,
+                    name='callback',
+                    dedupe=self.dedupe)
+            dispatchers[lava_server].dispatch(None, dt, request.user.username, event)
+        for dispatcher in dispatchers.values():
+            dispatcher.flush()
+        return response.Response({'received': len(events)}, status=status.HTTP_202_ACCEPTED)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Import time and memory footprint of the listener.
+
+Each module is imported in a fresh interpreter, after django.setup(), and
+the wall clock time, peak RSS and number of loaded modules are reported
+(median of --runs runs). api.tasks is what the listener used to import;
+the listener command should not pull in requests, yaml or api.testminer.
+Run from the top of the source tree:
+
+    python benchmarks/import_time.py [--runs N] [module ...]
+
+For a per-module breakdown use python -X importtime (Python >= 3.7).
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = [
+    'listener.management.commands.startlistener',
+    'api.tasks',
+]
+
+HEAVY_MODULES = ['requests', 'yaml', 'api.testminer', 'api.tasks']
+
+PROBE = """
+import json, resource, sys, time
+start = time.time()
+import django
+django.setup()
+setup = time.time()
+__import__(%(module)r)
+end = time.time()
+print(json.dumps({
+    'setup': setup - start,
+    'import': end - setup,
+    'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': len(sys.modules),
+    'heavy': [m for m in %(heavy)r if m in sys.modules],
+}))
+"""
+
+
+def probe(module):
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'squadlavalistener.settings')
+    code = PROBE % {'module': module, 'heavy': HEAVY_MODULES}
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    args = parser.parse_args()
+
+    print("%-46s %10s %10s %10s %8s" % ("module", "setup ms", "import ms", "maxrss KB", "modules"))
+    for module in args.modules:
+        runs = [probe(module) for i in range(args.runs)]
+        print("%-46s %10.1f %10.1f %10d %8d" % (
+            module,
+            median([r['setup'] for r in runs]) * 1000,
+            median([r['import'] for r in runs]) * 1000,
+            median([r['maxrss'] for r in runs]),
+            median([r['modules'] for r in runs]),
+        ))
+        if runs[0]['heavy']:
+            print("    also loads: %s" % ", ".join(runs[0]['heavy']))
+
+
+if __name__ == '__main__':
+    main()
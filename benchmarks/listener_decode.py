@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Per-message CPU cost of decoding LAVA events in the listener.
+
+Compares the original decoding (u() over all five frames, json.loads of the
+whole payload and debug logging of the payload) with listener.decode for
+every installed JSON backend. Run from the top of the source tree:
+
+    python benchmarks/listener_decode.py [--messages N] [--padding BYTES] [--debug]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from listener.decode import EventDecoder, JSON_BACKENDS, json_backend  # noqa
+
+logger = logging.getLogger("benchmark")
+
+
+def sample_message(padding):
+    data = {
+        "job": "1234567",
+        "sub_id": "1234567.1",
+        "status": "Complete",
+        "state": "Finished",
+        "health": "Unknown",
+        "pipeline": True,
+        "description": "lkft-linux-stable-4.9-x15-boot-and-ltp",
+        "device": "x15-01",
+        "device_type": "x15",
+        "submitter": "lkft-bot",
+        "submit_time": "2017-03-01T10:00:00.000000+00:00",
+        "start_time": "2017-03-01T10:05:00.000000+00:00",
+        "end_time": "2017-03-01T11:05:00.000000+00:00",
+        "priority": 50,
+        "visibility": "Publicly visible",
+        "health_check": False,
+        "tags": ["usb-storage", "hdmi"],
+        "extra": "x" * padding,
+    }
+    return [
+        b"org.linaro.validation.testjob",
+        b"0a2f4a77-0c5b-4a4a-9a3c-97a8d1a3c5e1",
+        b"2017-03-01T11:05:00.123456",
+        b"lavaserver",
+        json.dumps(data).encode('utf-8'),
+    ]
+
+
+def baseline(message):
+    (topic, uuid, dt, username, data) = (m.decode('utf-8') for m in message[:])
+    logger.debug(topic)
+    logger.debug(data)
+    return uuid, dt, username, json.loads(data)
+
+
+def measure(name, function, message, count):
+    start = time.process_time() if hasattr(time, 'process_time') else time.clock()
+    for i in range(count):
+        function(message)
+    end = time.process_time() if hasattr(time, 'process_time') else time.clock()
+    per_message = (end - start) / count * 1000000
+    print("%-24s %8.2f us/message" % (name, per_message))
+    return per_message
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--padding', type=int, default=0,
+                        help='extra bytes of event data, to simulate larger payloads')
+    parser.add_argument('--debug', action='store_true',
+                        help='enable debug logging (to /dev/null) in the baseline')
+    args = parser.parse_args()
+
+    level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(stream=open(os.devnull, 'w'), level=level)
+
+    message = sample_message(args.padding)
+    print("payload: %d bytes, %d messages" % (len(message[4]), args.messages))
+    reference = measure("baseline", baseline, message, args.messages)
+    for backend in JSON_BACKENDS:
+        if json_backend(backend)[0] != backend:
+            continue
+        decoder = EventDecoder(backend)
+        cost = measure("decode (%s)" % backend, decoder.decode, message, args.messages)
+        print("%-24s %8.2fx" % ("", reference / cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Decoding of the (topic, uuid, dt, username, data) messages published by
+LAVA. Frames may be bytes or zmq.Frame objects received with copy=False.
+"""
+import json
+
+# the only fields of the event data used by the matching pipeline
+EVENT_FIELDS = ('job', 'sub_id', 'status', 'pipeline', 'description')
+
+JSON_BACKENDS = ('orjson', 'ujson', 'simplejson', 'json')
+
+
+def json_backend(name='json'):
+    """
+    Returns (name, loads) for the requested JSON module. 'auto' picks the
+    first of JSON_BACKENDS that is installed; unknown or missing backends
+    fall back to the standard library.
+    """
+    candidates = JSON_BACKENDS if name == 'auto' else (name, 'json')
+    for candidate in candidates:
+        try:
+            module = __import__(candidate)
+        except ImportError:
+            continue
+        if hasattr(module, 'loads'):
+            return candidate, module.loads
+    return 'json', json.loads
+
+
+def frame_bytes(frame):
+    return getattr(frame, 'bytes', frame)
+
+
+def frame_text(frame):
+    return frame_bytes(frame).decode('utf-8')
+
+
+class EventDecoder(object):
+
+    def __init__(self, backend='json'):
+        self.backend, self.loads = json_backend(backend)
+        # orjson parses buffers directly, the others need bytes or text
+        self.accepts_buffer = self.backend == 'orjson'
+
+    def topic(self, message):
+        return frame_text(message[0])
+
+    def data(self, frame):
+        if self.accepts_buffer:
+            content = getattr(frame, 'buffer', frame)
+        else:
+            content = frame_bytes(frame)
+            if self.backend == 'json' and not isinstance(content, str):
+                # json.loads only accepts bytes from Python 3.6 on
+                content = content.decode('utf-8')
+        data = self.loads(content)
+        return {key: data[key] for key in EVENT_FIELDS if key in data}
+
+    def decode(self, message):
+        """
+        Returns (uuid, dt, username, data), with data reduced to
+        EVENT_FIELDS. The topic is left alone; use topic() if needed.
+        """
+        return (
+            frame_text(message[1]),
+            frame_text(message[2]),
+            frame_text(message[3]),
+            self.data(message[4]),
+        )
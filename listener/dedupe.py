@@ -0,0 +1,45 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class EventDeduplicator(object):
+    """
+    Remembers up to maxsize event keys for ttl seconds. seen() returns True
+    for a key first seen less than ttl seconds ago; the oldest keys are
+    evicted first when the cache is full. It may be shared between threads,
+    as by the callback API.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def expire(self, now):
+        # entries are kept in insertion order, so expired ones come first
+        while self.entries:
+            key, timestamp = next(iter(self.entries.items()))
+            if now - timestamp < self.ttl:
+                break
+            del self.entries[key]
+
+    def seen(self, key):
+        with self.lock:
+            now = time.time()
+            self.expire(now)
+            if key in self.entries:
+                self.hits += 1
+                return True
+            self.misses += 1
+            self.entries[key] = now
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            return False
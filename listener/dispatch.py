@@ -0,0 +1,188 @@
+import calendar
+import logging
+import time
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from api import routing
+from listener import metrics, producer
+from listener.decode import EventDecoder
+from listener.dedupe import EventDeduplicator
+from listener.prefilter import PatternIndex, event_job_id, server_netloc
+
+logger = logging.getLogger(__name__)
+
+# raised by EventDecoder for malformed messages: missing frames, invalid
+# UTF-8 or JSON, data that is not an object or has no job
+DECODE_ERRORS = (ValueError, TypeError, IndexError, KeyError)
+
+
+def event_lag(dt, received_at):
+    """
+    Seconds between the LAVA event timestamp and received_at, or None if
+    the timestamp can't be parsed. Naive timestamps are assumed to be UTC.
+    """
+    try:
+        timestamp = parse_datetime(dt)
+    except (TypeError, ValueError):
+        return None
+    if timestamp is None:
+        return None
+    seconds = calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1000000.0
+    return received_at - seconds
+
+
+def default_dedupe():
+    ttl = getattr(settings, 'LISTENER_DEDUPE_TTL', 300)
+    if not ttl:
+        return None
+    return EventDeduplicator(getattr(settings, 'LISTENER_DEDUPE_SIZE', 10000), ttl)
+
+
+class EventDispatcher(object):
+    """
+    Sends LAVA events to the matching pipeline.
+
+    With batch_size > 1 events are collected and sent as a single
+    match_pattern_batch task once batch_size events are buffered or the
+    oldest one has waited batch_timeout milliseconds, whichever comes first.
+    The caller is responsible for calling flush() when timeout() expires.
+
+    When a journal is given, the journal sequence number passed along with
+    each event is acknowledged once the event was sent or filtered out.
+
+    Events with the same job (or sub_id) and status as one dispatched less
+    than LISTENER_DEDUPE_TTL seconds before are dropped as duplicates.
+    """
+
+    def __init__(self, lava_server=None, batch_size=None, batch_timeout=None, index=None, journal=None, name=None, dedupe=None):
+        if batch_size is None:
+            batch_size = getattr(settings, 'LISTENER_BATCH_SIZE', 1)
+        if batch_timeout is None:
+            batch_timeout = getattr(settings, 'LISTENER_BATCH_TIMEOUT', 200)
+        self.name = name or lava_server or ""
+        self.netloc = server_netloc(lava_server)
+        self.batch_size = max(int(batch_size), 1)
+        self.batch_timeout = int(batch_timeout)
+        self.events = []
+        self.seqs = []
+        self.first_event_at = None
+        self.journal = journal
+        self.decoder = EventDecoder(getattr(settings, 'LISTENER_JSON_BACKEND', 'json'))
+        self.dedupe = dedupe
+        if dedupe is None:
+            self.dedupe = default_dedupe()
+        self.index = index
+        if index is None and getattr(settings, 'LISTENER_PREFILTER', True):
+            self.index = PatternIndex()
+            self.index.rebuild()
+
+    def handle(self, message, topic=None):
+        """
+        Journals, decodes and dispatches a (topic, uuid, dt, username, data)
+        ZMQ multipart message. Frames may be zmq.Frame objects received
+        with copy=False; only the event fields the pipeline needs are kept.
+        """
+        received_at = time.time()
+        seq = None
+        if self.journal is not None:
+            seq = self.journal.append(message, received_at)
+        start = time.time()
+        event = self.decode(message, seq)
+        if event is None:
+            # acknowledged so that replays don't stumble on it again
+            self.ack([seq])
+            return
+        if topic is None:
+            topic = self.decoder.topic(message)
+        (uuid, dt, username, data) = event
+        metrics.DECODE_SECONDS.observe(time.time() - start, listener=self.name)
+        metrics.MESSAGES.inc(listener=self.name, topic=topic)
+        lag = event_lag(dt, received_at)
+        if lag is not None:
+            metrics.EVENT_LAG_SECONDS.observe(lag, listener=self.name)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: %s" % (topic, data))
+        self.dispatch(uuid, dt, username, data, seq)
+
+    def decode(self, message, seq=None):
+        """
+        Returns (uuid, dt, username, data), or None for a message that
+        can't be decoded, which is logged and counted as dropped.
+        """
+        try:
+            self.decoder.topic(message)
+            event = self.decoder.decode(message)
+            event_job_id(event[3])
+        except DECODE_ERRORS as e:
+            logger.warning("%s: dropping undecodable message (journal record %s): %r" % (self.name, seq, e))
+            metrics.EVENTS_DROPPED.inc(listener=self.name, reason='undecodable')
+            return None
+        return event
+
+    def duplicate(self, data):
+        if self.dedupe is None:
+            return False
+        key = (self.netloc, event_job_id(data), data.get('status'))
+        if self.dedupe.seen(key):
+            metrics.DEDUPE_LOOKUPS.inc(listener=self.name, result='hit')
+            return True
+        metrics.DEDUPE_LOOKUPS.inc(listener=self.name, result='miss')
+        return False
+
+    def dispatch(self, uuid, dt, username, data, seq=None):
+        if self.index is not None and not self.index.matches(self.netloc, data):
+            logger.debug("no active pattern for job %s" % data.get('job'))
+            metrics.EVENTS_DROPPED.inc(listener=self.name, reason='no pattern')
+            self.ack([seq])
+            return
+        if self.duplicate(data):
+            logger.debug("duplicate event for job %s" % data.get('job'))
+            metrics.EVENTS_DROPPED.inc(listener=self.name, reason='duplicate')
+            self.ack([seq])
+            return
+        if self.batch_size == 1:
+            self.send(producer.MATCH_PATTERN, 1, (uuid, dt, username, data, self.netloc),
+                      routing.event_priority(data))
+            self.ack([seq])
+            return
+        if not self.events:
+            self.first_event_at = time.time()
+        self.events.append((uuid, dt, username, data))
+        self.seqs.append(seq)
+        if len(self.events) >= self.batch_size:
+            self.flush()
+
+    def timeout(self):
+        """
+        Milliseconds until the pending batch has to be flushed, or None if
+        there is nothing pending.
+        """
+        if not self.events:
+            return None
+        elapsed = (time.time() - self.first_event_at) * 1000
+        return max(int(self.batch_timeout - elapsed), 0)
+
+    def flush(self):
+        if not self.events:
+            return
+        events, self.events = self.events, []
+        seqs, self.seqs = self.seqs, []
+        logger.debug("dispatching batch of %d events" % len(events))
+        self.send(producer.MATCH_PATTERN_BATCH, len(events), (events, self.netloc),
+                  routing.batch_priority(events))
+        self.ack(seqs)
+
+    def send(self, task_name, count, args, priority=None):
+        start = time.time()
+        producer.send_task(task_name, *args, priority=priority,
+                           queue=routing.queue_for(routing.EVENTS, self.netloc))
+        metrics.ENQUEUE_SECONDS.observe(time.time() - start, listener=self.name)
+        metrics.EVENTS_DISPATCHED.inc(count, listener=self.name)
+
+    def ack(self, seqs):
+        if self.journal is None:
+            return
+        for seq in seqs:
+            self.journal.ack(seq)
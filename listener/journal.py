@@ -0,0 +1,242 @@
+import glob
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+
+from django.conf import settings
+
+from listener.decode import frame_bytes
+
+logger = logging.getLogger(__name__)
+
+# record: sequence number, receive time, payload length; the payload is the
+# number of frames followed by each frame prefixed with its length
+RECORD = struct.Struct('>QdI')
+COUNT = struct.Struct('>I')
+ACK = struct.Struct('>Q')
+
+
+def encode_frames(frames):
+    chunks = [COUNT.pack(len(frames))]
+    for frame in frames:
+        frame = bytes(frame_bytes(frame))
+        chunks.append(COUNT.pack(len(frame)))
+        chunks.append(frame)
+    return b''.join(chunks)
+
+
+def decode_frames(payload):
+    (count,) = COUNT.unpack_from(payload, 0)
+    offset = COUNT.size
+    frames = []
+    for i in range(count):
+        (length,) = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        frames.append(payload[offset:offset + length])
+        offset += length
+    return frames
+
+
+def read_segment(path):
+    """
+    Yields (seq, timestamp, frames) for every complete record in a segment.
+    A truncated record at the end (e.g. after a crash) is ignored.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset + RECORD.size <= size:
+                seq, timestamp, length = RECORD.unpack_from(data, offset)
+                start = offset + RECORD.size
+                if start + length > size:
+                    break
+                yield seq, timestamp, decode_frames(data[start:start + length])
+                offset = start + length
+        finally:
+            data.close()
+
+
+def read_acks(path):
+    acks = set()
+    if not os.path.exists(path):
+        return acks
+    with open(path, 'rb') as f:
+        content = f.read()
+    for offset in range(0, len(content) - len(content) % ACK.size, ACK.size):
+        acks.add(ACK.unpack_from(content, offset)[0])
+    return acks
+
+
+def journal_segments(directory, name):
+    pattern = os.path.join(directory, "%s-*.journal" % name)
+    return sorted(glob.glob(pattern))
+
+
+def journal_acks(directory, name):
+    # a record may be acknowledged after its segment was rotated, so the
+    # acknowledgements of all segments are considered together
+    acks = set()
+    for path in journal_segments(directory, name):
+        acks.update(read_acks(path + '.ack'))
+    return acks
+
+
+def unacked_events(directory, name, min_age=0):
+    """
+    Yields (segment, seq, timestamp, frames) for the journal records not
+    acknowledged yet that are at least min_age seconds old. Acknowledge
+    them by appending ACK.pack(seq) to the segment's ".ack" file.
+    """
+    newest = time.time() - min_age
+    acks = journal_acks(directory, name)
+    for path in journal_segments(directory, name):
+        for seq, timestamp, frames in read_segment(path):
+            if seq not in acks and timestamp <= newest:
+                yield path, seq, timestamp, frames
+
+
+class EventJournal(object):
+    """
+    Append-only journal of the raw ZMQ messages received by a listener.
+
+    Messages are appended before they are dispatched and acknowledged once
+    they were handed to the broker (or dropped on purpose), so that events
+    lost while the broker is unavailable can be replayed later. The journal
+    is split in segments of about segment_size bytes, named after the
+    sequence number of their first record, with acknowledged sequence
+    numbers kept in a ".ack" file next to each segment. Writes are fsync'ed
+    every fsync_events records or fsync_interval milliseconds, whichever
+    comes first.
+    """
+
+    def __init__(self, directory, name, segment_size=64 * 1024 * 1024,
+                 fsync_events=100, fsync_interval=1000):
+        self.directory = directory
+        self.name = name
+        self.segment_size = segment_size
+        self.fsync_events = fsync_events
+        self.fsync_interval = fsync_interval
+        self.segment = None
+        self.acks = None
+        self.pending = 0
+        self.last_sync = time.time()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.seq = self.last_seq() + 1
+        self.rotate()
+
+    def segments(self):
+        return journal_segments(self.directory, self.name)
+
+    def last_seq(self):
+        last = 0
+        for path in reversed(self.segments()):
+            for seq, timestamp, frames in read_segment(path):
+                last = max(last, seq)
+            if last:
+                break
+        return last
+
+    def segment_path(self, seq):
+        return os.path.join(self.directory, "%s-%020d.journal" % (self.name, seq))
+
+    def rotate(self):
+        if self.segment is not None:
+            self.sync()
+            self.segment.close()
+            self.acks.close()
+        path = self.segment_path(self.seq)
+        self.segment = open(path, 'ab')
+        self.acks = open(path + '.ack', 'ab')
+        self.purge()
+
+    def append(self, frames, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        payload = encode_frames(frames)
+        seq = self.seq
+        self.segment.write(RECORD.pack(seq, timestamp, len(payload)))
+        self.segment.write(payload)
+        self.seq += 1
+        self.written()
+        if self.segment.tell() >= self.segment_size:
+            self.rotate()
+        return seq
+
+    def ack(self, seq):
+        if seq is None:
+            return
+        self.acks.write(ACK.pack(seq))
+        self.written()
+
+    def written(self):
+        self.pending += 1
+        if self.pending >= self.fsync_events:
+            self.sync()
+
+    def timeout(self):
+        """
+        Milliseconds until pending writes have to be synced, or None.
+        """
+        if not self.pending:
+            return None
+        elapsed = (time.time() - self.last_sync) * 1000
+        return max(int(self.fsync_interval - elapsed), 0)
+
+    def sync(self):
+        for f in (self.segment, self.acks):
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = 0
+        self.last_sync = time.time()
+
+    def purge(self):
+        """
+        Removes the oldest segments as long as every record in them has
+        been acknowledged. A segment's ".ack" file can only hold
+        acknowledgements for records of that segment or older ones, so it
+        is safe to remove it together with its segment.
+        """
+        current = self.segment_path(self.seq)
+        acks = journal_acks(self.directory, self.name)
+        for path in self.segments():
+            if path == current:
+                break
+            if not all(seq in acks for seq, timestamp, frames in read_segment(path)):
+                break
+            logger.info("removing fully acknowledged journal segment %s" % path)
+            os.unlink(path)
+            if os.path.exists(path + '.ack'):
+                os.unlink(path + '.ack')
+
+    def close(self):
+        self.sync()
+        self.segment.close()
+        self.acks.close()
+
+
+def journal_name(listener_name):
+    return re.sub(r'[^\w.-]+', '_', listener_name)
+
+
+def listener_journal(listener):
+    """
+    Returns the journal for a listener, or None if LISTENER_JOURNAL_DIR is
+    not set.
+    """
+    directory = getattr(settings, 'LISTENER_JOURNAL_DIR', None)
+    if not directory:
+        return None
+    return EventJournal(
+        directory,
+        journal_name(listener.name),
+        segment_size=getattr(settings, 'LISTENER_JOURNAL_SEGMENT_SIZE', 64 * 1024 * 1024),
+        fsync_events=getattr(settings, 'LISTENER_JOURNAL_FSYNC_EVENTS', 100),
+        fsync_interval=getattr(settings, 'LISTENER_JOURNAL_FSYNC_INTERVAL', 1000))
@@ -0,0 +1,151 @@
+import json
+import os
+import random
+import time
+import uuid
+import zmq
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from listener.decode import frame_bytes
+from listener.journal import read_segment
+
+DEFAULT_STATUS_MIX = "Submitted:3,Running:3,Complete:2,Incomplete:1,Canceled:1"
+
+
+def parse_status_mix(value):
+    mix = []
+    for item in value.split(","):
+        status, _, weight = item.partition(":")
+        try:
+            mix.append((status.strip(), float(weight or 1)))
+        except ValueError:
+            raise CommandError("invalid status mix entry: %s" % item)
+    return mix
+
+
+def recorded_messages(path):
+    """
+    Reads messages recorded either in a listener journal segment or in a
+    file with one JSON array of the five frames per line.
+    """
+    if path.endswith('.journal'):
+        for seq, timestamp, frames in read_segment(path):
+            yield [frame_bytes(f) for f in frames]
+        return
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield [frame.encode('utf-8') for frame in json.loads(line)]
+
+
+class Command(BaseCommand):
+    help = 'Publishes synthetic or recorded LAVA job events on a local ZMQ PUB socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bind', default='tcp://*:5500',
+                            help='address of the PUB socket (default: tcp://*:5500)')
+        parser.add_argument('--topic', default='org.linaro.validation.testjob')
+        parser.add_argument('--rate', type=float, default=100.0,
+                            help='target events per second (default: 100)')
+        parser.add_argument('--burst', type=int, default=1,
+                            help='events sent back to back per burst; bursts are spaced '
+                                 'so that the average rate is --rate (default: 1)')
+        parser.add_argument('--count', type=int, default=1000,
+                            help='number of events to send, 0 for no limit (default: 1000)')
+        parser.add_argument('--status-mix', default=DEFAULT_STATUS_MIX,
+                            help='weighted job statuses (default: %s)' % DEFAULT_STATUS_MIX)
+        parser.add_argument('--first-job', type=int, default=1,
+                            help='lowest synthetic job id (default: 1)')
+        parser.add_argument('--jobs', type=int, default=1000,
+                            help='number of distinct synthetic job ids (default: 1000)')
+        parser.add_argument('--pipeline', action='store_true',
+                            help='mark synthetic jobs as pipeline (V2) jobs')
+        parser.add_argument('--replay', metavar='FILE',
+                            help='replay messages from a journal segment or a JSON lines file '
+                                 'instead of generating them')
+        parser.add_argument('--warmup', type=float, default=1.0,
+                            help='seconds to wait for subscribers to connect (default: 1)')
+        parser.add_argument('--report-interval', type=float, default=5.0,
+                            help='seconds between progress reports (default: 5)')
+
+    def synthetic_messages(self, options):
+        statuses, weights = zip(*parse_status_mix(options['status_mix']))
+        topic = options['topic'].encode('utf-8')
+        while True:
+            status = self.weighted_choice(statuses, weights)
+            job = options['first_job'] + random.randrange(options['jobs'])
+            data = {
+                'job': str(job),
+                'status': status,
+                'pipeline': options['pipeline'],
+                'description': 'synthetic job %d' % job,
+            }
+            yield [
+                topic,
+                str(uuid.uuid4()).encode('utf-8'),
+                datetime.utcnow().isoformat().encode('utf-8'),
+                b'generate-events',
+                json.dumps(data).encode('utf-8'),
+            ]
+
+    @staticmethod
+    def weighted_choice(items, weights):
+        point = random.uniform(0, sum(weights))
+        for item, weight in zip(items, weights):
+            point -= weight
+            if point <= 0:
+                return item
+        return items[-1]
+
+    def handle(self, *args, **options):
+        if options['rate'] <= 0:
+            raise CommandError("--rate must be positive")
+        if options['replay']:
+            if not os.path.exists(options['replay']):
+                raise CommandError("no such file: %s" % options['replay'])
+            messages = recorded_messages(options['replay'])
+        else:
+            messages = self.synthetic_messages(options)
+
+        context = zmq.Context()
+        socket = context.socket(zmq.PUB)
+        socket.bind(options['bind'])
+        self.stdout.write("publishing on %s" % options['bind'])
+        time.sleep(options['warmup'])
+
+        burst = max(options['burst'], 1)
+        interval = burst / options['rate']
+        count = options['count']
+        sent = 0
+        start = time.time()
+        next_burst = start
+        last_report, last_sent = start, 0
+        try:
+            for message in messages:
+                if sent % burst == 0:
+                    delay = next_burst - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_burst += interval
+                socket.send_multipart(message)
+                sent += 1
+                now = time.time()
+                if now - last_report >= options['report_interval']:
+                    self.stdout.write("%d events, %.1f/s over the last %.0fs" % (
+                        sent, (sent - last_sent) / (now - last_report), now - last_report))
+                    last_report, last_sent = now, sent
+                if count and sent >= count:
+                    break
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.time() - start
+        socket.close(linger=1000)
+        context.term()
+
+        achieved = sent / elapsed if elapsed > 0 else 0
+        self.stdout.write("sent %d events in %.2fs: %.1f events/s achieved, %.1f events/s target (%.0f%%)" % (
+            sent, elapsed, achieved, options['rate'], 100 * achieved / options['rate']))
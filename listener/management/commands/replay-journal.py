@@ -0,0 +1,68 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from listener.dispatch import EventDispatcher
+from listener.journal import ACK, journal_name, unacked_events
+from listener.models import LavaListener
+
+
+class Command(BaseCommand):
+    help = 'Re-drives the listener journal events that were never acknowledged'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--listener',
+            action='append',
+            default=[],
+            help='only replay the journal of this listener (may be repeated)',
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=10.0,
+            help='maximum number of events replayed per second (default: 10)',
+        )
+        parser.add_argument(
+            '--min-age',
+            type=float,
+            default=60.0,
+            help='skip events received less than this many seconds ago, which '
+                 'a running listener may still be dispatching (default: 60)',
+        )
+
+    def handle(self, *args, **options):
+        directory = getattr(settings, 'LISTENER_JOURNAL_DIR', None)
+        if not directory:
+            raise CommandError("LISTENER_JOURNAL_DIR is not set")
+
+        listeners = LavaListener.all()
+        if options['listener']:
+            listeners = [l for l in listeners if l.name in options['listener']]
+
+        interval = 1.0 / options['rate'] if options['rate'] > 0 else 0
+        for listener in listeners:
+            dispatcher = EventDispatcher(listener.lava_server, batch_size=1)
+            acks = {}
+            count = 0
+            next_at = time.time()
+            events = unacked_events(directory, journal_name(listener.name), options['min_age'])
+            for segment, seq, timestamp, frames in events:
+                delay = next_at - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                next_at = max(next_at, time.time()) + interval
+
+                # undecodable records are acknowledged without dispatching
+                # them, so that they don't stop every later replay
+                event = dispatcher.decode(frames, seq)
+                if event is not None:
+                    dispatcher.dispatch(*event)
+                if segment not in acks:
+                    acks[segment] = open(segment + '.ack', 'ab')
+                acks[segment].write(ACK.pack(seq))
+                count += 1
+            for f in acks.values():
+                f.close()
+            self.stdout.write("%s: replayed %d events" % (listener, count))
@@ -1,63 +1,227 @@
-import json
 import logging
 import multiprocessing
 import signal
 import zmq
 
-from zmq.utils.strtypes import u
+from collections import OrderedDict
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connection
 
+from listener.decode import frame_text
+from listener.dispatch import EventDispatcher
+from listener import metrics, producer
+from listener.journal import listener_journal
 from listener.models import LavaListener
-from api.tasks import match_pattern
+from listener.prefilter import PatternIndex
 
 logger = logging.getLogger(__name__)
 
+
+def subscriber(context, address, topics):
+    socket = context.socket(zmq.SUB)
+    # reconnect and heartbeat tuning, e.g. RECONNECT_IVL, HEARTBEAT_IVL;
+    # options not supported by the installed libzmq are ignored
+    for name, value in getattr(settings, 'LISTENER_ZMQ_OPTIONS', {}).items():
+        option = getattr(zmq, name, None)
+        if option is None:
+            logger.warning("unsupported ZMQ socket option: %s" % name)
+            continue
+        socket.setsockopt(option, value)
+    for topic in topics:
+        socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+    socket.connect(address)
+    return socket
+
+
+def min_timeout(*timeouts):
+    timeouts = [t for t in timeouts if t is not None]
+    if not timeouts:
+        return None
+    return min(timeouts)
+
+
+def serve_metrics(index, name):
+    address = getattr(settings, 'LISTENER_METRICS_ADDRESS', None)
+    if address:
+        metrics.serve(metrics.process_address(address, index, name))
+
+
+def journal_timeout(journal):
+    if journal is None:
+        return None
+    return journal.timeout()
+
+
 class ZMQDaemon(multiprocessing.Process):
 
-    def set_listener(self, listener):
+    def set_listener(self, listener, batch_size=None, batch_timeout=None, index=0):
         self.listener = listener
+        self.index = index
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
 
     def setup(self):
+        # don't share the parent's database connection
+        connection.close()
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.SUB)
-        self.socket.setsockopt_string(zmq.SUBSCRIBE, self.listener.topic_name)
-        self.socket.connect(self.listener.publisher_address)
+        self.socket = subscriber(
+            self.context, self.listener.publisher_address, [self.listener.topic_name])
         self.run_forever = True
+        self.journal = listener_journal(self.listener)
+        self.dispatcher = EventDispatcher(
+            self.listener.lava_server, self.batch_size, self.batch_timeout,
+            journal=self.journal, name=self.listener.name)
+        metrics.RECEIVE_HWM.set(self.socket.getsockopt(zmq.RCVHWM), listener=self.listener.name)
+        serve_metrics(self.index, self.listener.name)
 
     def run(self):
         self.setup()
         logger.info("starting listener process: %s" % self.listener)
         while True:
             try:
-                logger.debug("waiting for the message")
-                message = self.socket.recv_multipart()
-                logger.debug("received message")
-                (topic, uuid, dt, username, data) = (u(m) for m in message[:])
-                logger.debug(topic)
-                logger.debug(data)
-                match_pattern.delay(uuid, dt, username, json.loads(data))
+                timeout = min_timeout(self.dispatcher.timeout(), journal_timeout(self.journal))
+                if not self.socket.poll(timeout):
+                    if self.dispatcher.timeout() == 0:
+                        self.dispatcher.flush()
+                    if journal_timeout(self.journal) == 0:
+                        self.journal.sync()
+                    continue
+                message = self.socket.recv_multipart(copy=False)
+                self.dispatcher.handle(message)
+            except Exception as e:
+                logger.error(e)
+                pass
+
+
+class ZMQMultiplexer(multiprocessing.Process):
+    """
+    Services all listeners from a single process. Listeners sharing a
+    publisher address share one SUB socket subscribed to all their topics;
+    every socket is serviced from one zmq.Poller loop.
+    """
+
+    def set_listeners(self, listeners, batch_size=None, batch_timeout=None):
+        self.listeners = listeners
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+
+    def setup(self):
+        # don't share the parent's database connection
+        connection.close()
+        self.context = zmq.Context()
+        self.poller = zmq.Poller()
+        index = None
+        if getattr(settings, 'LISTENER_PREFILTER', True):
+            index = PatternIndex()
+            index.rebuild()
+
+        endpoints = OrderedDict()
+        for listener in self.listeners:
+            endpoints.setdefault(listener.publisher_address, []).append(listener)
+
+        self.routes = {}
+        self.dispatchers = []
+        for address, listeners in endpoints.items():
+            socket = subscriber(self.context, address, [l.topic_name for l in listeners])
+            self.poller.register(socket, zmq.POLLIN)
+            # longest topic first: ZMQ subscriptions are prefix matches
+            routes = []
+            for listener in sorted(listeners, key=lambda l: len(l.topic_name), reverse=True):
+                dispatcher = EventDispatcher(
+                    listener.lava_server, self.batch_size, self.batch_timeout, index,
+                    listener_journal(listener), listener.name)
+                metrics.RECEIVE_HWM.set(socket.getsockopt(zmq.RCVHWM), listener=listener.name)
+                routes.append((listener.topic_name, dispatcher))
+                self.dispatchers.append(dispatcher)
+            self.routes[socket] = routes
+        serve_metrics(0, 'all')
+
+    def route(self, socket, topic):
+        for topic_name, dispatcher in self.routes[socket]:
+            if topic.startswith(topic_name):
+                return dispatcher
+        return None
+
+    def timeout(self):
+        timeouts = [d.timeout() for d in self.dispatchers]
+        timeouts += [journal_timeout(d.journal) for d in self.dispatchers]
+        return min_timeout(*timeouts)
+
+    def run(self):
+        self.setup()
+        logger.info("starting listener process: %s" % ", ".join(str(l) for l in self.listeners))
+        while True:
+            try:
+                for socket, event in self.poller.poll(self.timeout()):
+                    message = socket.recv_multipart(copy=False)
+                    topic = frame_text(message[0])
+                    dispatcher = self.route(socket, topic)
+                    if dispatcher is None:
+                        logger.warning("no listener for topic %s" % topic)
+                        continue
+                    dispatcher.handle(message, topic)
+                for dispatcher in self.dispatchers:
+                    if dispatcher.timeout() == 0:
+                        dispatcher.flush()
+                    if journal_timeout(dispatcher.journal) == 0:
+                        dispatcher.journal.sync()
             except Exception as e:
                 logger.error(e)
                 pass
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='dispatch events in batches of up to this many (default: LISTENER_BATCH_SIZE)',
+        )
+        parser.add_argument(
+            '--batch-timeout',
+            type=int,
+            default=None,
+            help='maximum time in ms an event waits for its batch (default: LISTENER_BATCH_TIMEOUT)',
+        )
+        parser.add_argument(
+            '--single-process',
+            action='store_true',
+            default=getattr(settings, 'LISTENER_SINGLE_PROCESS', False),
+            help='service all listeners from one process instead of one process per listener',
+        )
+
     def handle(self, **kwargs):
+        logging.basicConfig(level=getattr(settings, 'LISTENER_LOG_LEVEL', 'INFO'))
         # only start listeners that aren't already running
         listeners = LavaListener.all()
 
         default_handler = signal.getsignal(signal.SIGINT)
         signal.signal(signal.SIGINT, signal.SIG_IGN)
         zmqd_ref_array = []
-        for listener in listeners:
-            logger.info("starting %s" % listener)
-            zmqd = ZMQDaemon()
-            zmqd.set_listener(listener)
+        if kwargs['single_process'] and listeners:
+            logger.info("starting %d listeners in a single process" % len(listeners))
+            zmqd = ZMQMultiplexer()
+            zmqd.set_listeners(listeners, kwargs['batch_size'], kwargs['batch_timeout'])
             zmqd.start()
             zmqd_ref_array.append(zmqd)
+        else:
+            for index, listener in enumerate(listeners):
+                logger.info("starting %s" % listener)
+                zmqd = ZMQDaemon()
+                zmqd.set_listener(listener, kwargs['batch_size'], kwargs['batch_timeout'], index)
+                zmqd.start()
+                zmqd_ref_array.append(zmqd)
         signal.signal(signal.SIGINT, default_handler)
         signal.signal(signal.SIGTERM, lambda signum, frame: {})
+        if getattr(settings, 'LISTENER_RECONCILE_ON_START', True):
+            # catch up with the jobs that finished while nobody listened
+            try:
+                producer.send_task(producer.RECONCILE_PATTERNS)
+            except Exception as e:
+                logger.warning("could not schedule the pattern reconciler: %s" % e)
         try:
             signal.pause()
         except KeyboardInterrupt:
@@ -66,5 +230,3 @@ class Command(BaseCommand):
         for zmqd in zmqd_ref_array:
             zmqd.terminate()
             zmqd.join()
-
-
@@ -0,0 +1,240 @@
+"""
+Minimal in-process metrics, exposed in the Prometheus text format.
+
+Each process has its own REGISTRY; serve() exposes it over HTTP, either on
+a TCP "host:port" address or on a "unix:/path/to/socket" address.
+"""
+import logging
+import os
+import socket
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import UnixStreamServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import UnixStreamServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (name, value))
+    return "{%s}" % ",".join(escaped)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.type),
+        ]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.samples(key, value))
+        return lines
+
+    def samples(self, key, value):
+        return ["%s%s %s" % (self.name, format_labels(self.labels, key), repr(float(value)))]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            counts, total, total_sum = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key][1] = total + 1
+            self.values[key][2] = total_sum + value
+
+    def samples(self, key, value):
+        counts, total, total_sum = value
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            labels = format_labels(self.labels, key, [('le', repr(float(bound)))])
+            lines.append("%s_bucket%s %d" % (self.name, labels, count))
+        labels = format_labels(self.labels, key, [('le', '+Inf')])
+        lines.append("%s_bucket%s %d" % (self.name, labels, total))
+        labels = format_labels(self.labels, key)
+        lines.append("%s_count%s %d" % (self.name, labels, total))
+        lines.append("%s_sum%s %s" % (self.name, labels, repr(float(total_sum))))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+MESSAGES = REGISTRY.counter(
+    'listener_messages_received_total',
+    'ZMQ messages received, per listener and topic',
+    ['listener', 'topic'])
+EVENTS_DROPPED = REGISTRY.counter(
+    'listener_events_dropped_total',
+    'Events not sent to the broker, per reason',
+    ['listener', 'reason'])
+EVENTS_DISPATCHED = REGISTRY.counter(
+    'listener_events_dispatched_total',
+    'Events sent to the broker',
+    ['listener'])
+DEDUPE_LOOKUPS = REGISTRY.counter(
+    'listener_dedupe_lookups_total',
+    'Duplicate event cache lookups, per result (hit or miss)',
+    ['listener', 'result'])
+DECODE_SECONDS = REGISTRY.histogram(
+    'listener_decode_seconds',
+    'Time spent decoding a ZMQ message',
+    ['listener'])
+ENQUEUE_SECONDS = REGISTRY.histogram(
+    'listener_enqueue_seconds',
+    'Time spent publishing a task to the broker',
+    ['listener'])
+EVENT_LAG_SECONDS = REGISTRY.histogram(
+    'listener_event_lag_seconds',
+    'Time between the LAVA event timestamp and its reception',
+    ['listener'])
+# libzmq silently drops messages on SUB sockets once the receive high
+# water mark is reached and does not count them; the configured limit is
+# exposed so that alerts can compare it with the receive rate.
+RECEIVE_HWM = REGISTRY.gauge(
+    'listener_zmq_receive_hwm',
+    'Configured ZMQ receive high water mark (messages)',
+    ['listener'])
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        content = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def address_string(self):
+        # unix sockets have no client address
+        return str(self.client_address)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class UnixHTTPServer(UnixStreamServer):
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        UnixStreamServer.server_bind(self)
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+
+def serve(address):
+    """
+    Serves REGISTRY from a background thread. address is either
+    "host:port" or "unix:/path/to/socket".
+    """
+    if address.startswith('unix:'):
+        server = UnixHTTPServer(address[len('unix:'):], MetricsHandler)
+    else:
+        host, port = address.rsplit(':', 1)
+        server = HTTPServer((host, int(port)), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info("serving metrics on %s" % address)
+    return server
+
+
+def write_textfile(path):
+    """
+    Writes REGISTRY to path, replacing it atomically so that collectors
+    never read a partial file.
+    """
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(REGISTRY.render())
+    os.rename(tmp, path)
+
+
+def process_address(address, index, name):
+    """
+    Address for the index-th listener process: TCP ports are offset by
+    index, unix socket paths get the process name appended.
+    """
+    if address.startswith('unix:'):
+        return "%s-%s.sock" % (address, name)
+    host, port = address.rsplit(':', 1)
+    return "%s:%d" % (host, int(port) + index)
@@ -9,11 +9,13 @@ class LavaListener():
     name = None
     publisher_address = None
     topic_name = None
+    lava_server = None
 
     def __init__(self, config):
         self.name = config['name']
         self.publisher_address = config['zmq_endpoint']
         self.topic_name = config['zmq_topic']
+        self.lava_server = config.get('lava_server')
 
     @classmethod
     def all(cls):
@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from api.models import Pattern
+
+logger = logging.getLogger(__name__)
+
+
+def server_netloc(url):
+    if not url:
+        return None
+    return urlsplit(url).netloc or url
+
+
+def event_job_id(data):
+    if 'sub_id' in data.keys():
+        return str(data['sub_id'])
+    return str(data['job'])
+
+
+class PatternIndex(object):
+    """
+    In-memory set of the (server, lava_job_id) keys of all active patterns.
+
+    Listeners use it to drop events for jobs nobody registered before they
+    are sent to the broker. The index is loaded incrementally (only patterns
+    newer than the last one seen), at most once every
+    LISTENER_PREFILTER_REFRESH milliseconds, and rebuilt from scratch every
+    LISTENER_PREFILTER_REBUILD seconds, so that deactivated and deleted
+    patterns eventually go away. Pattern saves and deletes done in the same
+    process are applied immediately. The index may be shared between
+    threads, as by the callback API, so changes and lookups hold a lock.
+    """
+
+    def __init__(self):
+        self.rebuild_interval = getattr(settings, 'LISTENER_PREFILTER_REBUILD', 300)
+        self.refresh_interval = getattr(settings, 'LISTENER_PREFILTER_REFRESH', 1000) / 1000.0
+        self.patterns = {}
+        self.keys = defaultdict(set)
+        self.job_ids = defaultdict(set)
+        self.last_pk = 0
+        self.last_rebuild = 0
+        self.last_refresh = 0
+        self.lock = threading.RLock()
+        post_save.connect(self.pattern_saved, sender=Pattern, weak=False)
+        post_delete.connect(self.pattern_deleted, sender=Pattern, weak=False)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, pk, lava_server, lava_job_id):
+        key = (server_netloc(lava_server), str(lava_job_id))
+        if self.patterns.get(pk) == key:
+            return
+        self.discard(pk)
+        self.patterns[pk] = key
+        self.keys[key].add(pk)
+        self.job_ids[key[1]].add(pk)
+        self.last_pk = max(self.last_pk, pk)
+
+    def discard(self, pk):
+        key = self.patterns.pop(pk, None)
+        if key is None:
+            return
+        for index, item in ((self.keys, key), (self.job_ids, key[1])):
+            index[item].discard(pk)
+            if not index[item]:
+                del index[item]
+
+    def rebuild(self):
+        with self.lock:
+            self.patterns = {}
+            self.keys = defaultdict(set)
+            self.job_ids = defaultdict(set)
+            self.last_pk = 0
+            self.load(Pattern.objects.filter(is_active=True))
+            self.last_rebuild = self.last_refresh = time.time()
+        logger.info("pattern index rebuilt: %d keys" % len(self))
+
+    def refresh(self):
+        with self.lock:
+            now = time.time()
+            if now - self.last_rebuild > self.rebuild_interval:
+                self.rebuild()
+            elif now - self.last_refresh >= self.refresh_interval:
+                self.load(Pattern.objects.filter(is_active=True, pk__gt=self.last_pk))
+                self.last_refresh = now
+
+    def load(self, queryset):
+        for pk, lava_server, lava_job_id in queryset.values_list('pk', 'lava_server', 'lava_job_id'):
+            self.add(pk, lava_server, lava_job_id)
+
+    def lookup(self, netloc, job_id):
+        if netloc is None:
+            return job_id in self.job_ids
+        return (netloc, job_id) in self.keys
+
+    def matches(self, netloc, data):
+        """
+        Returns True if there may be an active pattern for the event. Misses
+        trigger an incremental refresh first, unless one was done less than
+        refresh_interval ago; the events of a pattern created within that
+        time may be dropped, and the reconciler picks up their jobs.
+        """
+        job_id = event_job_id(data)
+        with self.lock:
+            if self.lookup(netloc, job_id):
+                return True
+            self.refresh()
+            return self.lookup(netloc, job_id)
+
+    def pattern_saved(self, sender, instance, **kwargs):
+        with self.lock:
+            if instance.is_active:
+                self.add(instance.pk, instance.lava_server, instance.lava_job_id)
+            else:
+                self.discard(instance.pk)
+
+    def pattern_deleted(self, sender, instance, **kwargs):
+        with self.lock:
+            self.discard(instance.pk)
@@ -0,0 +1,15 @@
+"""
+Thin task producer for the listener.
+
+Tasks are sent by name, so the listener does not need to import api.tasks
+and with it requests, yaml, api.testminer and the worker logging setup.
+"""
+from squadlavalistener import celery_app
+
+MATCH_PATTERN = 'api.tasks.match_pattern'
+MATCH_PATTERN_BATCH = 'api.tasks.match_pattern_batch'
+RECONCILE_PATTERNS = 'api.tasks.reconcile_patterns'
+
+
+def send_task(name, *args, **options):
+    return celery_app.send_task(name, args=args, **options)
@@ -1,3 +1,190 @@
+import os
+import shutil
+import tempfile
+import threading
+
 from django.test import TestCase
 
-# Create your tests here.
+from listener.dedupe import EventDeduplicator
+from listener.dispatch import EventDispatcher
+from listener.journal import EventJournal, RECORD, read_segment, unacked_events
+
+
+class EventJournalTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def journal(self, **kwargs):
+        return EventJournal(self.directory, 'test', **kwargs)
+
+    def unacked(self):
+        return [(seq, frames) for path, seq, timestamp, frames in unacked_events(self.directory, 'test')]
+
+    def test_append_and_read_back(self):
+        journal = self.journal()
+        first = journal.append([b'topic', b'uuid', b'{"job": 1}'])
+        second = journal.append([b'topic', b'uuid', b'{"job": 2}'])
+        journal.close()
+        self.assertEqual(second, first + 1)
+        self.assertEqual([
+            (first, [b'topic', b'uuid', b'{"job": 1}']),
+            (second, [b'topic', b'uuid', b'{"job": 2}']),
+        ], self.unacked())
+
+    def test_acked_records_are_not_replayed(self):
+        journal = self.journal()
+        first = journal.append([b'one'])
+        second = journal.append([b'two'])
+        journal.ack(first)
+        journal.close()
+        self.assertEqual([(second, [b'two'])], self.unacked())
+
+    def test_sequence_continues_after_reopening(self):
+        journal = self.journal()
+        journal.append([b'one'])
+        last = journal.append([b'two'])
+        journal.close()
+        journal = self.journal()
+        self.assertEqual(last + 1, journal.append([b'three']))
+        journal.close()
+
+    def test_truncated_record_is_ignored(self):
+        journal = self.journal()
+        seq = journal.append([b'complete'])
+        path = journal.segment.name
+        journal.close()
+        # a crash in the middle of an append leaves a partial record
+        with open(path, 'ab') as f:
+            f.write(RECORD.pack(seq + 1, 0, 100) + b'partial')
+        self.assertEqual([seq], [s for s, timestamp, frames in read_segment(path)])
+        journal = self.journal()
+        self.assertEqual(seq + 1, journal.seq)
+        journal.close()
+
+    def test_min_age(self):
+        journal = self.journal()
+        journal.append([b'old'], timestamp=1)
+        journal.append([b'new'])
+        journal.close()
+        events = unacked_events(self.directory, 'test', min_age=60)
+        self.assertEqual([[b'old']], [frames for path, seq, timestamp, frames in events])
+
+    def test_acknowledged_segments_are_purged(self):
+        journal = self.journal(segment_size=1)
+        first = journal.append([b'one'])
+        first_segment = journal.segment_path(first)
+        journal.ack(first)
+        journal.append([b'two'])
+        journal.close()
+        self.assertFalse(os.path.exists(first_segment))
+        self.assertFalse(os.path.exists(first_segment + '.ack'))
+
+    def test_segments_with_unacked_records_are_kept(self):
+        journal = self.journal(segment_size=1)
+        first = journal.append([b'one'])
+        journal.append([b'two'])
+        journal.append([b'three'])
+        journal.close()
+        self.assertTrue(os.path.exists(journal.segment_path(first)))
+        self.assertEqual([b'one', b'two', b'three'], [frames[0] for seq, frames in self.unacked()])
+
+    def test_ack_after_rotation(self):
+        journal = self.journal(segment_size=1)
+        first = journal.append([b'one'])
+        second = journal.append([b'two'])
+        # acknowledged in a later segment's ack file
+        journal.ack(first)
+        journal.close()
+        self.assertEqual([(second, [b'two'])], self.unacked())
+
+
+class MatchAll(object):
+
+    def matches(self, netloc, data):
+        return True
+
+
+class RecordingDispatcher(EventDispatcher):
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingDispatcher, self).__init__(*args, **kwargs)
+        self.sent = []
+
+    def send(self, task_name, count, args, priority=None):
+        self.sent.append(args)
+
+
+class UndecodableEventTest(TestCase):
+
+    GOOD = [b'topic', b'uuid', b'2017-01-01T00:00:00', b'user', b'{"job": 1, "status": "Complete"}']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = EventJournal(self.directory, 'test')
+        self.dispatcher = RecordingDispatcher(batch_size=1, index=MatchAll(), journal=self.journal)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def unacked(self):
+        self.journal.sync()
+        return [frames for path, seq, timestamp, frames in unacked_events(self.directory, 'test')]
+
+    def test_undecodable_messages_are_acked(self):
+        bad = [
+            self.GOOD[:4] + [b'{not json'],
+            self.GOOD[:4] + [b'[1, 2]'],
+            self.GOOD[:4] + [b'{"status": "Complete"}'],
+            self.GOOD[:4] + [b'\xff\xfe'],
+            self.GOOD[:2],
+        ]
+        for message in bad:
+            self.dispatcher.handle(message)
+        self.dispatcher.handle(self.GOOD)
+        self.assertEqual(1, len(self.dispatcher.sent))
+        self.assertEqual([], self.unacked())
+
+    def test_replay_decode(self):
+        self.assertIsNone(self.dispatcher.decode(self.GOOD[:4] + [b'{not json']))
+        uuid, dt, username, data = self.dispatcher.decode(self.GOOD)
+        self.assertEqual({'job': 1, 'status': 'Complete'}, data)
+
+
+class EventDeduplicatorTest(TestCase):
+
+    def test_repeated_key(self):
+        dedupe = EventDeduplicator(maxsize=10, ttl=300)
+        self.assertFalse(dedupe.seen('a'))
+        self.assertTrue(dedupe.seen('a'))
+
+    def test_oldest_keys_are_evicted(self):
+        dedupe = EventDeduplicator(maxsize=2, ttl=300)
+        for key in ('a', 'b', 'c'):
+            dedupe.seen(key)
+        self.assertFalse(dedupe.seen('a'))
+
+    def test_expired_keys_are_forgotten(self):
+        dedupe = EventDeduplicator(maxsize=10, ttl=0)
+        dedupe.seen('a')
+        self.assertFalse(dedupe.seen('a'))
+
+    def test_shared_between_threads(self):
+        dedupe = EventDeduplicator(maxsize=100000, ttl=300)
+        first = []
+
+        def run():
+            for key in range(2000):
+                if not dedupe.seen(key):
+                    first.append(key)
+
+        threads = [threading.Thread(target=run) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(list(range(2000)), sorted(first))